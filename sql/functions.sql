@@ -0,0 +1,133 @@
+-- Funções do banco usadas pelo bot (Supabase/Postgres).
+-- Aplique este arquivo no SQL Editor do Supabase sempre que ele mudar:
+-- todas as definições usam "create or replace" e podem ser reaplicadas.
+
+-- Busca o contato pelo número e x-quepasa-wid e atualiza seu status em uma
+-- única ida ao banco. Retorna o contato como estava antes da atualização.
+-- Se o contato não existe e p_thread_id é nulo, não retorna nada: a aplicação
+-- cria a thread na OpenAI e chama a função de novo com p_thread_id para inseri-lo.
+create or replace function public.upsert_contact(
+    p_phone text,
+    p_wid text,
+    p_name text,
+    p_from_me boolean,
+    p_thread_id text default null
+)
+returns setof public.contacts
+language plpgsql
+as $$
+declare
+    v_assistant_id public.assistants.assistant_id%type;
+    v_user_id public.contacts.user_id%type;
+    v_contact public.contacts;
+begin
+    -- Busca o assistente para obter o assistant_id e o dono (user_id, gravado só em contatos novos)
+    select a.assistant_id, a.user_id into v_assistant_id, v_user_id
+    from public.assistants a
+    where a."x-quepasa-wid" = p_wid
+    limit 1;
+
+    if not found then
+        raise exception 'Assistente não encontrado para x-quepasa-wid: %', p_wid;
+    end if;
+
+    select * into v_contact
+    from public.contacts c
+    where c.whatsapp = p_phone and c."x-quepasa-wid" = p_wid
+    limit 1
+    for update;
+
+    if not found then
+        if p_thread_id is null then
+            return;
+        end if;
+
+        return query
+        insert into public.contacts (
+            name, whatsapp, status, "x-quepasa-wid", last_contact,
+            thread_id, followup, etapa, from_me, instance_name, user_id
+        )
+        values (
+            coalesce(p_name, 'User ' || p_phone), p_phone, 'ativo', p_wid, now(),
+            p_thread_id, false, 'conexão', p_from_me, v_assistant_id, v_user_id
+        )
+        returning *;
+        return;
+    end if;
+
+    if p_from_me then
+        update public.contacts set
+            last_contact = now(),
+            from_me = true,
+            status = 'cooldown',
+            cooldown_until = now() + interval '24 hours',
+            instance_name = v_assistant_id
+        where whatsapp = p_phone and "x-quepasa-wid" = p_wid;
+    else
+        update public.contacts set
+            last_contact = now(),
+            name = coalesce(p_name, v_contact.name),  -- usa chat_title como prioridade
+            status = 'ativo',
+            instance_name = v_assistant_id
+        where whatsapp = p_phone and "x-quepasa-wid" = p_wid;
+    end if;
+
+    return next v_contact;
+end;
+$$;
+
+-- Coloca o contato em cooldown por 24 horas após uma mensagem enviada pelo próprio
+-- número, a não ser que ele esteja pausado, em uma única ida ao banco.
+-- Retorna o status do contato depois da chamada, ou null se ele não existe.
+create or replace function public.set_cooldown_if_not_paused(
+    p_phone text,
+    p_wid text
+)
+returns text
+language plpgsql
+as $$
+declare
+    v_status public.contacts.status%type;
+begin
+    update public.contacts set
+        last_contact = now(),
+        status = 'cooldown',
+        cooldown_until = now() + interval '24 hours',
+        from_me = true
+    where whatsapp = p_phone and "x-quepasa-wid" = p_wid
+      and status is distinct from 'pausado';
+
+    if found then
+        return 'cooldown';
+    end if;
+
+    -- Nada foi atualizado: o contato está pausado ou não existe
+    select c.status into v_status
+    from public.contacts c
+    where c.whatsapp = p_phone and c."x-quepasa-wid" = p_wid
+    limit 1;
+
+    return v_status;
+end;
+$$;
+
+-- Coloca o contato em cooldown por 24 horas ao transferir o atendimento para um
+-- humano, registrando o motivo da transferência.
+create or replace function public.set_transfer_cooldown(
+    p_phone text,
+    p_wid text,
+    p_reason text
+)
+returns void
+language sql
+as $$
+    update public.contacts set
+        status = 'cooldown',
+        transfer_reason = p_reason,
+        cooldown_until = now() + interval '24 hours'
+    where whatsapp = p_phone and "x-quepasa-wid" = p_wid;
+$$;
+
+-- create_appointment não é mais usada: o agendamento usa o contato já carregado
+-- e o dono do assistente (em cache) e insere o evento direto em calendar_events.
+drop function if exists public.create_appointment(text, text, text, jsonb);
@@ -1,53 +1,84 @@
 from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, field_validator
 from dotenv import load_dotenv
 import httpx
 import os
-from openai import OpenAI
-from typing import Optional, Dict, Any
+from openai import AsyncOpenAI
+from typing import Optional, Dict, Any, Tuple
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 import base64
-from datetime import datetime, timedelta
+import hashlib
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from urllib.parse import urlparse
 from supabase import create_client
+from postgrest.types import ReturnMethod
 import asyncio
-import tempfile
 import re
-import traceback
-import json
+import orjson
+import signal
+import socket
+import subprocess
 import sys
-import pytz
+import time
+import weakref
+from cachetools import TTLCache
+import uvicorn
+
+try:
+    import uvloop
+except ImportError:  # uvloop não existe no Windows; usa o loop padrão do asyncio
+    uvloop = None
+
+try:
+    import asyncpg
+except ImportError:  # sem asyncpg, o status dos contatos é lido pela API REST do Supabase
+    asyncpg = None
 
 # Configuração de logging com UTF-8
+# Os registros passam por uma fila e são gravados em arquivo/console por uma
+# thread separada (QueueListener), fora do caminho das requisições
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(
+    log_queue,
+    logging.FileHandler('bot.log', encoding='utf-8'),
+    logging.StreamHandler()
+)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     encoding='utf-8',  # Forçar UTF-8
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
 logger = logging.getLogger(__name__)
 
+_logging_stopped = False
+
+def shutdown_logging():
+    """Drena a fila de logs e fecha os handlers. Pode ser chamada mais de uma vez."""
+    global _logging_stopped
+    if not _logging_stopped:
+        _logging_stopped = True
+        log_listener.stop()
+    logging.shutdown()
+
+atexit.register(shutdown_logging)
+
 # Função para adicionar logs
-def log_with_instance(message: str, agent_id: str, level: str = "INFO"):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-    log_message = f"[{timestamp}] [{agent_id}] {message}"
-    
-    # Escreve no arquivo de log
-    with open('bot.log', 'a', encoding='utf-8') as f:
-        f.write(f"{log_message}\n")
-    
-    # Também usa o logger padrão
-    if level == "INFO":
-        logger.info(log_message)
-    elif level == "ERROR":
-        logger.error(log_message)
-    elif level == "WARNING":
-        logger.warning(log_message)
-    elif level == "DEBUG":
-        logger.debug(log_message)
+def log_with_instance(message: str, agent_id: str, *args, level: str = "INFO", exc_info: bool = False):
+    """Registra a mensagem com o agent_id como prefixo. Os argumentos são formatados
+    pelo logging (estilo %s) só quando o nível está habilitado; a data já vem do formatter."""
+    # O logger padrão já grava em bot.log (via QueueListener, fora do event loop)
+    logger.log(logging.getLevelName(level), "[%s] " + message, agent_id, *args, exc_info=exc_info)
 
 # Carrega variáveis de ambiente
 try:
@@ -60,6 +91,17 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 QUEPASA_API_URL = os.getenv("QUEPASA_API_URL", "")
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL", "")  # Conexão direta ao Postgres (opcional, pooler em modo sessão)
+UVICORN_UDS = os.getenv("UVICORN_UDS", "")  # Socket UNIX opcional quando há proxy reverso local
+# Número de processos do servidor. O padrão é 1 porque a fila de mensagens
+# pendentes fica em memória, por processo
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Tempo (segundos) que uma resposta do assistente pode ser reaproveitada para a mesma
+# mensagem recebida pelo mesmo assistente. 0 (padrão) desliga o cache
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "0"))
+# Máximo de mensagens de um contato enviadas ao assistente em uma única run; as
+# excedentes ficam para o lote seguinte. 0 (padrão) envia todas as acumuladas
+MESSAGE_BATCH_MAX = int(os.getenv("MESSAGE_BATCH_MAX", "0"))
 
 # Logs para debug
 logger.info(f"QUEPASA_API_URL: {QUEPASA_API_URL}")
@@ -75,7 +117,77 @@ if not QUEPASA_API_URL:
 if not SUPABASE_URL or not SUPABASE_KEY:
     logger.error("SUPABASE_URL ou SUPABASE_KEY não definidas no ambiente")
 
-app = FastAPI(title="WhatsApp GPT Bot")
+def quepasa_api_url() -> str:
+    """Retorna a QUEPASA_API_URL com protocolo (https quando ausente)."""
+    api_url = QUEPASA_API_URL
+    if not api_url.startswith(("http://", "https://")):
+        # Default to https if no protocol is found
+        api_url = f"https://{api_url}"
+        logger.warning(f"QUEPASA_API_URL was missing protocol. Prepended 'https://'. New URL: {api_url}")
+    return api_url
+
+# Tempo máximo do aquecimento de conexões na inicialização
+WARMUP_TIMEOUT_SECONDS = 10
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cliente HTTP compartilhado para as chamadas de saída (Quepasa, webhooks),
+    # reaproveitando conexões em vez de abrir uma nova a cada mensagem
+    # HTTP/2 multiplexa os envios concorrentes numa mesma conexão TLS por host
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=30),
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0)
+    )
+
+    # Aquece DNS, TCP e TLS dos clientes antes de aceitar tráfego,
+    # para que a primeira mensagem não pague o handshake completo
+    # O aquecimento é opcional: se demorar mais que WARMUP_TIMEOUT_SECONDS, o servidor sobe assim mesmo
+    logger.info("Aquecendo conexões com OpenAI, Supabase e Quepasa...")
+    try:
+        openai_result, supabase_result, quepasa_result = await asyncio.wait_for(
+            asyncio.gather(
+                # Usa a base_url do cliente (proxy ou Azure, se configurado)
+                openai_http_client.head(str(openai_client.base_url)),
+                asyncio.to_thread(supabase.table('assistants').select('id').limit(1).execute),
+                # Qualquer resposta serve: o objetivo é deixar a conexão com o Quepasa aberta no pool
+                app.state.http.head(quepasa_api_url()) if QUEPASA_API_URL else asyncio.sleep(0),
+                return_exceptions=True
+            ),
+            timeout=WARMUP_TIMEOUT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Aquecimento das conexões excedeu %s segundos; iniciando sem ele", WARMUP_TIMEOUT_SECONDS)
+    else:
+        if isinstance(openai_result, Exception):
+            logger.warning(f"Não foi possível aquecer a conexão com a OpenAI: {str(openai_result)}")
+        if isinstance(supabase_result, Exception):
+            logger.warning(f"Não foi possível aquecer a conexão com o Supabase: {str(supabase_result)}")
+        if isinstance(quepasa_result, Exception):
+            logger.warning(f"Não foi possível aquecer a conexão com o Quepasa: {str(quepasa_result)}")
+
+    # Pool de conexões diretas ao Postgres para as leituras/escritas de status no webhook,
+    # sem passar pela API REST. Sem SUPABASE_DB_URL (ou se a conexão falhar) usa o Supabase
+    app.state.pg_pool = None
+    if SUPABASE_DB_URL and asyncpg is not None:
+        try:
+            app.state.pg_pool = await asyncpg.create_pool(
+                dsn=SUPABASE_DB_URL,
+                min_size=2,
+                max_size=10,
+                max_inactive_connection_lifetime=1800
+            )
+        except Exception as e:
+            logger.warning(f"Não foi possível conectar ao Postgres, usando a API do Supabase: {str(e)}")
+
+    yield
+
+    if app.state.pg_pool is not None:
+        await app.state.pg_pool.close()
+    await app.state.http.aclose()
+    await openai_http_client.aclose()
+
+app = FastAPI(title="WhatsApp GPT Bot", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Configuração CORS
 app.add_middleware(
@@ -94,22 +206,126 @@ async def log_requests(request: Request, call_next):
     logger.info(f"Método: {request.method}")
     logger.info(f"Headers: {dict(request.headers)}")
     
-    # Tenta ler o corpo da requisição
-    try:
-        body = await request.body()
-        logger.info(f"Corpo da requisição: {body.decode()}")
-    except Exception as e:
-        logger.error(f"Erro ao ler corpo da requisição: {str(e)}")
+    # O corpo só é lido para o log em nível DEBUG: ler aqui obriga a guardar o corpo inteiro em memória
+    if logger.isEnabledFor(logging.DEBUG):
+        try:
+            body = await request.body()
+            logger.debug("Corpo da requisição: %s", body.decode(errors='replace'))
+        except Exception as e:
+            logger.error(f"Erro ao ler corpo da requisição: {str(e)}")
     
     response = await call_next(request)
     return response
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Cliente OpenAI assíncrono único para toda a aplicação, com pool de conexões reaproveitado
+openai_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=openai_http_client)
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# Dicionário para armazenar mensagens pendentes
-pending_messages = {}
-pending_tasks = {}
+async def supabase_execute(query):
+    """Executa uma consulta do cliente síncrono do Supabase em uma thread,
+    sem bloquear o event loop durante a ida ao banco."""
+    return await asyncio.to_thread(query.execute)
+
+# Limite de contatos em 30 dias para cada plano
+PLAN_LIMITS = {
+    'starter': 100,
+    'essential': 500,
+    'agent': 2000,
+    'empresa': 10000
+}
+# Janela usada na contagem de contatos do plano
+CONTACT_LIMIT_WINDOW = timedelta(days=30)
+# Fuso usado na data/hora enviada ao assistente
+BRASILIA_TZ = ZoneInfo('America/Sao_Paulo')
+
+# Caches em memória: assistentes mudam raramente, o plano do usuário pode mudar a qualquer momento
+assistant_cache = TTLCache(maxsize=1024, ttl=300)
+assistant_wid_cache = TTLCache(maxsize=1024, ttl=300)
+# Um lock por x-quepasa-wid: mensagens simultâneas do mesmo número fazem uma única busca quando o cache expira.
+# O lock só existe enquanto alguma busca o usa, para que wids desconhecidos não acumulem entradas
+assistant_wid_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+user_plan_cache = TTLCache(maxsize=1024, ttl=60)
+# O link de uma mídia não muda depois de cadastrado
+media_cache = TTLCache(maxsize=1024, ttl=3600)
+# Respostas do assistente por (assistente, mensagem), só quando RESPONSE_CACHE_TTL está ativo
+response_cache = TTLCache(maxsize=2048, ttl=RESPONSE_CACHE_TTL) if RESPONSE_CACHE_TTL > 0 else None
+
+async def get_assistant_by_id(agent_id: str) -> Optional[Dict[str, Any]]:
+    """Busca o assistente pelo id, usando o cache de 5 minutos.
+    Retorna None se não encontrar (resultado negativo não é guardado)."""
+    assistant = assistant_cache.get(agent_id)
+    if assistant is None:
+        response = await supabase_execute(supabase.table('assistants').select('*').eq('id', agent_id))
+        if not response.data:
+            return None
+        assistant = response.data[0]
+        assistant_cache[agent_id] = assistant
+    return assistant
+
+async def get_assistant_by_wid(quepasa_wid: str) -> Optional[Dict[str, Any]]:
+    """Busca o assistente pelo x-quepasa-wid, usando o cache de 5 minutos.
+    Retorna None se não encontrar (resultado negativo não é guardado)."""
+    assistant = assistant_wid_cache.get(quepasa_wid)
+    if assistant is None:
+        lock = assistant_wid_locks.get(quepasa_wid)
+        if lock is None:
+            lock = assistant_wid_locks[quepasa_wid] = asyncio.Lock()
+        async with lock:
+            # Outra requisição pode ter preenchido o cache enquanto esperávamos o lock
+            assistant = assistant_wid_cache.get(quepasa_wid)
+            if assistant is None:
+                response = await supabase_execute(supabase.table('assistants').select('id, token, assistant_id').eq('x-quepasa-wid', quepasa_wid).limit(1))
+                if not response.data:
+                    return None
+                assistant = response.data[0]
+                assistant_wid_cache[quepasa_wid] = assistant
+    return assistant
+
+async def get_contact_status(phone: str, quepasa_wid: str) -> Optional[str]:
+    """Retorna o status do contato, ou None se ele ainda não existe."""
+    if app.state.pg_pool is not None:
+        return await app.state.pg_pool.fetchval(
+            'select status from public.contacts where whatsapp = $1 and "x-quepasa-wid" = $2 limit 1',
+            phone, quepasa_wid
+        )
+    response = await supabase_execute(supabase.table('contacts').select('status').eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).limit(1))
+    return response.data[0]['status'] if response.data else None
+
+async def set_contact_cooldown(phone: str, quepasa_wid: str) -> Optional[str]:
+    """Coloca o contato em cooldown após uma mensagem enviada pelo próprio número, exceto se
+    estiver pausado (função set_cooldown_if_not_paused, em sql/functions.sql).
+    Retorna o status do contato depois da chamada, ou None se ele não existe."""
+    if app.state.pg_pool is not None:
+        return await app.state.pg_pool.fetchval(
+            'select public.set_cooldown_if_not_paused($1, $2)',
+            phone, quepasa_wid
+        )
+    response = await supabase_execute(supabase.rpc('set_cooldown_if_not_paused', {
+        'p_phone': phone,
+        'p_wid': quepasa_wid
+    }))
+    return response.data
+
+@dataclass(slots=True)
+class MessageSlot:
+    """Mensagens de um contato aguardando processamento e a única tarefa que as consome."""
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    task: Optional[asyncio.Task] = None
+
+# Mensagens pendentes por contato (phone:agent_id). Cada contato tem no máximo uma tarefa
+# consumindo sua fila, então dois lotes do mesmo contato nunca rodem ao mesmo tempo
+message_slots: Dict[str, MessageSlot] = {}
+
+def release_message_slot(key: str, task: asyncio.Task):
+    """Chamada quando a tarefa de um contato termina: remove o contato de message_slots
+    se a fila ficou vazia, para o dicionário não crescer com contatos inativos.
+    Se chegou mensagem nesse meio tempo, o webhook já criou outra tarefa e o contato fica."""
+    slot = message_slots.get(key)
+    if slot is not None and slot.task is task and slot.queue.empty():
+        del message_slots[key]
 
 class MessageContextInfo(BaseModel):
     deviceListMetadata: Dict[str, Any] = None
@@ -168,80 +384,73 @@ class ChatInfo(BaseModel):
     id: str
     title: Optional[str] = None
 
-class Attachment(BaseModel):
-    mime: Optional[str] = None
-    filelength: Optional[int] = None
-    seconds: Optional[int] = None
-
 class QuepasaMessage(BaseModel):
     id: str
     timestamp: str
     type: str
     chat: ChatInfo
     text: Optional[str] = None
-    attachment: Optional[Attachment] = None
-    fromme: Any  # Pode ser string "false"/"true" ou booleano
-    frominternal: Any  # Pode ser string "false"/"true" ou booleano
+    attachment: Optional[Dict[str, Any]] = None
+    fromme: bool = False
+    frominternal: bool = False
+
+    @field_validator('fromme', 'frominternal', mode='before')
+    @classmethod
+    def parse_flag(cls, value: Any) -> bool:
+        # Pode ser string "false"/"true" ou booleano
+        return value if isinstance(value, bool) else str(value).lower() == 'true'
 
 class QuepasaWebhook(BaseModel):
     body: QuepasaMessage
 
+@dataclass(slots=True)
+class WebhookMsg:
+    """Campos da mensagem do Quepasa usados pelo webhook, resolvidos uma única vez."""
+    phone: str
+    from_me: bool
+    message_type: str
+    message_id: str
+    text: Optional[str]
+    chat_title: Optional[str]
+
+    @classmethod
+    def from_quepasa(cls, message: QuepasaMessage) -> "WebhookMsg":
+        return cls(
+            phone=message.chat.id.split('@')[0],
+            from_me=message.fromme,
+            message_type=message.type,
+            message_id=message.id,
+            text=message.text,
+            chat_title=message.chat.title
+        )
+
 async def check_and_create_contact(phone: str, quepasa_wid: str, push_name: str, from_me: bool, chat_title: str = None) -> Optional[Dict]:
     try:
         # Limpa o número do telefone (remove @s.whatsapp.net)
         phone = phone.split('@')[0]
         
-        # Busca o assistente para obter o assistant_id
-        assistant_response = supabase.table('assistants').select('assistant_id').eq('x-quepasa-wid', quepasa_wid).execute()
-        if not assistant_response.data or len(assistant_response.data) == 0:
-            logger.error(f"Assistente não encontrado para x-quepasa-wid: {quepasa_wid}")
-            raise Exception("Assistente não encontrado")
-            
-        assistant_id = assistant_response.data[0]['assistant_id']
-        
-        # Busca o contato - Usando nome real da coluna 'x-quepasa-wid'
-        response = supabase.table('contacts').select('*').eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).execute()
+        # Busca e atualiza o contato em uma única ida ao banco (função upsert_contact, em sql/functions.sql).
+        # Para contatos existentes, retorna o registro como estava antes da atualização
+        params = {
+            'p_phone': phone,
+            'p_wid': quepasa_wid,
+            'p_name': chat_title or push_name or None,  # Usa chat_title como prioridade
+            'p_from_me': from_me
+        }
+        response = await supabase_execute(supabase.rpc('upsert_contact', params))
         
         if not response.data:
-            # Se não existe, cria um novo contato
-            thread = openai_client.beta.threads.create()
-            new_contact = {
-                'name': chat_title or push_name or f'User {phone}',  # Usa chat_title como prioridade
-                'whatsapp': phone,
-                'status': 'ativo',
-                'x-quepasa-wid': quepasa_wid,
-                'last_contact': datetime.utcnow().isoformat(),
-                'thread_id': thread.id,
-                'followup': False,
-                'etapa': 'conexão',
-                'from_me': from_me,
-                'instance_name': assistant_id
-            }
-            response = supabase.table('contacts').insert(new_contact).execute()
+            # Se não existe, cria a thread na OpenAI e insere o novo contato
+            thread = await openai_client.beta.threads.create()
+            response = await supabase_execute(supabase.rpc('upsert_contact', {**params, 'p_thread_id': thread.id}))
             logger.info(f"Novo contato criado: {phone}")
             return response.data[0]
         
         contact = response.data[0]
         
         if from_me:
-            cooldown_end = (datetime.utcnow() + timedelta(hours=24)).isoformat()
-            supabase.table('contacts').update({
-                'last_contact': datetime.utcnow().isoformat(),
-                'from_me': True,
-                'status': 'cooldown',
-                'cooldown_until': cooldown_end,
-                'thread_id': contact.get('thread_id'),  # Preserva o thread_id
-                'instance_name': assistant_id
-            }).eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).execute()
             logger.info(f"Contato {phone} entrou em cooldown")
         else:
-            supabase.table('contacts').update({
-                'last_contact': datetime.utcnow().isoformat(),
-                'name': chat_title or push_name or contact['name'],  # Usa chat_title como prioridade
-                'thread_id': contact.get('thread_id'),  # Preserva o thread_id
-                'status': 'ativo',  # Garantindo que seja 'ativo' em vez de 'active'
-                'instance_name': assistant_id
-            }).eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).execute()
             logger.info(f"Contato {phone} atualizado")
         
         return contact
@@ -253,7 +462,7 @@ async def check_and_create_contact(phone: str, quepasa_wid: str, push_name: str,
 async def process_image(image_base64: str) -> str:
     try:
         # Analisa a imagem usando gpt-4o (que tem capacidade de visão)
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o",  # Use gpt-4o que tem visão, não gpt-4o-mini
             messages=[
                 {
@@ -266,7 +475,8 @@ async def process_image(image_base64: str) -> str:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
+                                "url": f"data:image/jpeg;base64,{image_base64}",
+                                "detail": "low"  # 85 tokens por imagem; suficiente para fotos do WhatsApp
                             }
                         }
                     ]
@@ -283,23 +493,11 @@ async def process_image(image_base64: str) -> str:
 
 async def process_audio(audio_base64: str) -> str:
     try:
-        # Decodifica o áudio base64
-        audio_bytes = base64.b64decode(audio_base64)
-        
-        # Cria um arquivo temporário para o áudio
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_audio:
-            temp_audio.write(audio_bytes)
-            temp_audio_path = temp_audio.name
-
-        # Transcreve o áudio usando OpenAI
-        with open(temp_audio_path, 'rb') as audio_file:
-            transcript = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-
-        # Limpa o arquivo temporário
-        os.unlink(temp_audio_path)
+        # Decodifica o áudio base64 e transcreve usando OpenAI, enviando os bytes direto (sem arquivo temporário)
+        transcript = await openai_client.audio.transcriptions.create(
+            model="whisper-1",
+            file=("audio.ogg", base64.b64decode(audio_base64), "audio/ogg")
+        )
 
         return transcript.text
 
@@ -313,12 +511,11 @@ async def send_webhook_request(function_name: str, function_args: dict) -> bool:
         webhook_base_url = "https://webhook.ganchodigital.com.br/webhook"
         webhook_url = f"{webhook_base_url}/{function_name}"
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                webhook_url,
-                json=function_args,
-                timeout=30
-            )
+        response = await app.state.http.post(
+            webhook_url,
+            content=orjson.dumps(function_args),
+            headers={"Content-Type": "application/json"}
+        )
             
         logger.info(f"Webhook chamado para função {function_name}: Status {response.status_code}")
         return response.status_code in [200, 201, 202]
@@ -326,6 +523,32 @@ async def send_webhook_request(function_name: str, function_args: dict) -> bool:
         logger.error(f"Erro ao chamar webhook para função {function_name}: {str(e)}")
         return False
 
+RE_NON_DIGITS = re.compile(r'\D')
+
+def _format_br_phone(number: str) -> str:
+    """Normaliza um número brasileiro para envio pelo Quepasa: só dígitos,
+    sem o 9 inicial do celular e com o código do país (55)."""
+    # Remove caracteres não numéricos
+    number = RE_NON_DIGITS.sub('', number)
+    
+    # Verifica formato: DDD + 9 dígitos com 9 inicial -> remove o 9
+    if len(number) >= 3:  # Tem pelo menos DDD
+        ddd = number[:2]
+        numero = number[2:]
+        
+        if len(numero) == 9 and numero[0] == '9':
+            numero = numero[1:]  # Remove o 9 inicial
+            logger.info(f"Número após formatação: {ddd + numero}")
+        
+        number = ddd + numero
+        
+        # Adiciona código do país se não tiver
+        if not number.startswith('55'):
+            number = '55' + number
+            logger.info(f"Número após adicionar código do país: {number}")
+    
+    return number
+
 async def send_notification(
     target_number: str,
     client_number: str,
@@ -338,24 +561,7 @@ async def send_notification(
     try:
         # Formata o número de destino
         if target_number:
-            # Remove caracteres não numéricos
-            target_number = ''.join(filter(str.isdigit, target_number))
-            
-            # Verifica formato: DDD + 9 dígitos com 9 inicial -> remove o 9
-            if len(target_number) >= 3:  # Tem pelo menos DDD
-                ddd = target_number[:2]
-                numero = target_number[2:]
-                
-                if len(numero) == 9 and numero[0] == '9':
-                    numero = numero[1:]  # Remove o 9 inicial
-                    logger.info(f"Número após formatação: {ddd + numero}")
-                
-                target_number = ddd + numero
-                
-                # Adiciona código do país se não tiver
-                if not target_number.startswith('55'):
-                    target_number = '55' + target_number
-                    logger.info(f"Número após adicionar código do país: {target_number}")
+            target_number = _format_br_phone(target_number)
 
         notification_message = (
             "Um cliente está aguardando o seu contato\n\n"
@@ -381,6 +587,31 @@ async def send_notification(
         logger.error(f"Erro ao enviar notificação: {str(e)}")
         return False
 
+async def get_user_plan(user_id: str) -> str:
+    """Busca o plano do usuário, usando o cache de 60 segundos.
+    Só guarda no cache quando o usuário é encontrado."""
+    user_plan = user_plan_cache.get(user_id)
+    if user_plan is not None:
+        return user_plan
+    
+    try:
+        user_data = await supabase_execute(supabase.table('users').select('plan').eq('uuid', user_id).limit(1))
+        if user_data.data:
+            user_plan = user_data.data[0].get('plan')
+            if not user_plan:
+                logger.warning(f"Campo 'plan' não preenchido para o usuário {user_id}. Usando plano 'starter'")
+                user_plan = 'starter'  # Plano padrão
+            user_plan_cache[user_id] = user_plan
+        else:
+            logger.error(f"Usuário não encontrado: {user_id}. Usando plano 'starter'")
+            user_plan = 'starter'  # Plano padrão
+    except Exception as e:
+        logger.error(f"Erro ao buscar plano do usuário: {str(e)}")
+        # Usa plano starter como fallback
+        user_plan = 'starter'
+    
+    return user_plan
+
 async def check_contact_limit(agent_id: str, contact_number: str) -> bool:
     """
     Verifica se o usuário atingiu o limite de contatos do seu plano.
@@ -389,81 +620,37 @@ async def check_contact_limit(agent_id: str, contact_number: str) -> bool:
     try:
         # Busca o usuário responsável pelo assistente
         logger.info(f"Verificando limite para assistente: {agent_id}")
-        assistant_data = supabase.table('assistants').select(
-            'user_id'
-        ).eq('id', agent_id).execute()
+        assistant = await get_assistant_by_id(agent_id)
         
-        if not assistant_data.data or len(assistant_data.data) == 0:
+        if not assistant:
             logger.error(f"Assistente não encontrado: {agent_id}")
             return True  # Permite continuar se não encontrar o assistente
         
-        user_id = assistant_data.data[0]['user_id']
+        user_id = assistant['user_id']
         logger.info(f"ID do usuário encontrado: {user_id}")
         
-        # Tenta obter a estrutura da tabela users primeiro
-        try:
-            # Lista todas as colunas da tabela users
-            logger.info("Verificando o nome correto da coluna na tabela users...")
-            
-            # Tentativa com uma abordagem diferente - consultar todos os campos
-            user_data = supabase.table('users').select('*').eq('uuid', user_id).execute()
-            if user_data.data and len(user_data.data) > 0:
-                logger.info(f"Colunas disponíveis na tabela users: {list(user_data.data[0].keys())}")
-                user_plan = user_data.data[0].get('plan')
-                if not user_plan:
-                    logger.warning(f"Campo 'plan' não encontrado no usuário. Dados disponíveis: {user_data.data[0]}")
-                    user_plan = 'starter'  # Plano padrão
-            else:
-                # Tenta com diferentes nomes possíveis de coluna
-                for possible_id_column in ['uuid', 'user_id', 'id', 'ID']:
-                    try:
-                        logger.info(f"Tentando usar coluna '{possible_id_column}' na tabela users")
-                        user_data = supabase.table('users').select('*').eq(possible_id_column, user_id).execute()
-                        if user_data.data and len(user_data.data) > 0:
-                            logger.info(f"Coluna '{possible_id_column}' funciona! Colunas disponíveis: {list(user_data.data[0].keys())}")
-                            user_plan = user_data.data[0].get('plan')
-                            if not user_plan:
-                                logger.warning(f"Campo 'plan' não encontrado. Dados disponíveis: {user_data.data[0]}")
-                                user_plan = 'starter'  # Plano padrão
-                            break
-                    except Exception as e:
-                        logger.warning(f"Falha ao tentar coluna '{possible_id_column}': {str(e)}")
-                else:
-                    # Se nenhuma coluna funcionar
-                    logger.error(f"Não foi possível encontrar o usuário com nenhum campo de ID. Usando plano 'starter'")
-                    user_plan = 'starter'  # Plano padrão
-        except Exception as e:
-            logger.error(f"Erro ao tentar verificar estrutura da tabela: {str(e)}")
-            # Usa plano starter como fallback
-            user_plan = 'starter'
-        
-        # Define limite baseado no plano
-        plan_limits = {
-            'starter': 100,
-            'essential': 500,
-            'agent': 2000,
-            'empresa': 10000
-        }
+        user_plan = await get_user_plan(user_id)
         
         # Se user_plan estiver definido como None, use o valor padrão
         if not user_plan:
             user_plan = 'starter'
             
-        contact_limit = plan_limits.get(user_plan.lower() if isinstance(user_plan, str) else 'starter', 100)
+        contact_limit = PLAN_LIMITS.get(user_plan.lower() if isinstance(user_plan, str) else 'starter', 100)
         
         # Calcula data de 30 dias atrás
-        thirty_days_ago = datetime.now() - timedelta(days=30)
+        thirty_days_ago = datetime.now(timezone.utc) - CONTACT_LIMIT_WINDOW
         
         # Conta contatos do usuário nos últimos 30 dias
         try:
             # Tenta usar a coluna user_id que o assistente preencheu
-            contacts_data = supabase.table('contacts').select(
-                'id'
+            # Pede só a contagem ao Postgres, sem trazer as linhas
+            contacts_data = await supabase_execute(supabase.table('contacts').select(
+                'id', count='exact', head=True
             ).eq('user_id', user_id).gte(
                 'created_at', thirty_days_ago.isoformat()
-            ).execute()
+            ))
             
-            current_contacts = len(contacts_data.data) if contacts_data.data else 0
+            current_contacts = contacts_data.count or 0
             logger.info(f"Contatos nos últimos 30 dias: {current_contacts}")
         except Exception as e:
             logger.error(f"Erro ao contar contatos: {str(e)}")
@@ -504,8 +691,9 @@ async def send_quepasa_message(phone: str, data: dict, token: str) -> bool:
             payload["url"] = data.get("url", "")
             payload["filename"] = data.get("filename", "")
         
-        # Log para debug
-        logger.info(f"Enviando payload para Quepasa: {json.dumps(payload)}")
+        # Serializa uma única vez, para o log e para o envio
+        body = orjson.dumps(payload)
+        logger.info("Enviando payload para Quepasa: %s", body.decode())
         
         # Envia a requisição com o token no header
         headers = {
@@ -514,19 +702,13 @@ async def send_quepasa_message(phone: str, data: dict, token: str) -> bool:
         }
         
         # Ensure QUEPASA_API_URL has a protocol
-        api_url = QUEPASA_API_URL
-        if not api_url.startswith(("http://", "https://")):
-            # Default to https if no protocol is found
-            api_url = f"https://{api_url}"
-            logger.warning(f"QUEPASA_API_URL was missing protocol. Prepended 'https://'. New URL: {api_url}")
-
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{api_url}/send",  # Use the potentially modified api_url
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+        api_url = quepasa_api_url()
+
+        response = await app.state.http.post(
+            f"{api_url}/send",  # Use the potentially modified api_url
+            headers=headers,
+            content=body
+        )
             
         logger.info(f"Resposta da requisição Quepasa: Status {response.status_code}")
         if response.status_code >= 400:
@@ -534,10 +716,17 @@ async def send_quepasa_message(phone: str, data: dict, token: str) -> bool:
             
         return response.status_code in [200, 201, 202]
     except Exception as e:
-        logger.error(f"Erro ao enviar mensagem via QuepasaAPI: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Erro ao enviar mensagem via QuepasaAPI: %s", e)
         return False
 
+# Expressões usadas na formatação das respostas para o WhatsApp
+RE_SEPARATOR = re.compile(r'\s*---\s*')
+RE_PUNCT = re.compile(r'([!?])(?!\s)(?!\n)')
+RE_BOLD = re.compile(r'\*\*([^*]+)\*\*')
+RE_STAR_WRAP = re.compile(r'\*\s*\n\s*([^*\n]+)\s*\n\s*\*')
+RE_BLANK_LINES = re.compile(r'\n\s*\n')
+RE_NUM_ITEM = re.compile(r'^\d+\.')
+
 async def send_whatsapp_messages(response_text: str, phone: str, agent_id: str, token: str):
     """Divide a mensagem do assistente em partes e envia como mensagens separadas."""
     try:
@@ -547,75 +736,82 @@ async def send_whatsapp_messages(response_text: str, phone: str, agent_id: str,
             logger.info(f"Número de telefone limpo: {phone}")
             
         # Remove os separadores "---"
-        response_text = re.sub(r'\s*---\s*', '\n', response_text)
+        response_text = RE_SEPARATOR.sub('\n', response_text)
         
         # Normaliza as quebras de linha
         response_text = response_text.replace('\r\n', '\n').replace('\r', '\n')
         
         # Adiciona quebra de linha após ! e ? apenas se não for seguido por espaço
-        response_text = re.sub(r'([!?])(?!\s)(?!\n)', r'\1\n', response_text)
+        response_text = RE_PUNCT.sub(r'\1\n', response_text)
         
         # Converte **texto** para *texto*
-        response_text = re.sub(r'\*\*([^*]+)\*\*', r'*\1*', response_text)
+        response_text = RE_BOLD.sub(r'*\1*', response_text)
         
         # Remove quebras de linha entre asteriscos mantendo o espaço
-        response_text = re.sub(r'\*\s*\n\s*([^*\n]+)\s*\n\s*\*', r'* \1 *', response_text)
+        response_text = RE_STAR_WRAP.sub(r'* \1 *', response_text)
         
         # Remove quebras de linha duplicadas
-        response_text = re.sub(r'\n\s*\n', '\n', response_text)
+        response_text = RE_BLANK_LINES.sub('\n', response_text)
         
-        # Divide o texto em blocos lógicos
+        # Divide o texto em blocos lógicos em uma única passada pelas linhas.
+        # Cada bloco é montado numa lista e só vira string quando é fechado.
         blocks = []
-        current_block = ""
-        lines = response_text.split('\n')
-        i = 0
+        block_parts = []
+        block_len = 0
+        block_numbered = False  # o bloco começa com um item numerado
+        in_item = False  # as próximas linhas não vazias continuam o item numerado
         
-        while i < len(lines):
-            line = lines[i].strip()
+        for line in response_text.split('\n'):
+            line = line.strip()
             
             # Se é um item numerado
-            if re.match(r'^\d+\.', line):
+            if RE_NUM_ITEM.match(line):
                 # Começa um novo bloco se necessário
-                if current_block and not re.match(r'^\d+\.', current_block.split('\n')[0]):
-                    blocks.append(current_block.strip())
-                    current_block = ""
+                if block_parts and not block_numbered:
+                    blocks.append(''.join(block_parts))
+                    block_parts = []
                 
                 # Adiciona o item numerado
-                if current_block:
-                    current_block += "\n"
-                current_block += line
-                
-                # Olha à frente para ver se há continuação do item
-                j = i + 1
-                while j < len(lines) and (not re.match(r'^\d+\.', lines[j].strip()) and lines[j].strip()):
-                    current_block += " " + lines[j].strip()
-                    j += 1
-                i = j
+                if block_parts:
+                    block_parts.append('\n')
+                    block_len += 1
+                else:
+                    block_numbered = True
+                    block_len = 0
+                block_parts.append(line)
+                block_len += len(line)
+                in_item = True
+            elif in_item and line:
+                # Continuação do item numerado
+                block_parts.append(' ')
+                block_parts.append(line)
+                block_len += 1 + len(line)
             else:
+                in_item = False
                 # Para texto normal, verifica o tamanho
-                if len(current_block + "\n" + line) > 150 and current_block:
-                    blocks.append(current_block.strip())
-                    current_block = line
-                else:
-                    if current_block and line:
-                        current_block += "\n" + line
-                    elif line:
-                        current_block = line
-                i += 1
+                if block_parts and block_len + 1 + len(line) > 150:
+                    blocks.append(''.join(block_parts))
+                    block_parts = []
+                if line:
+                    if block_parts:
+                        block_parts.append('\n')
+                        block_len += 1
+                    else:
+                        block_numbered = False
+                        block_len = 0
+                    block_parts.append(line)
+                    block_len += len(line)
         
         # Adiciona o último bloco
-        if current_block:
-            blocks.append(current_block.strip())
-        
-        # Remove blocos vazios e garante quebras de linha após ! e ? (exceto se seguido por espaço)
-        blocks = [re.sub(r'([!?])(?!\s)(?!\n)(?!$)', r'\1\n', b.strip()) for b in blocks if b.strip()]
+        if block_parts:
+            blocks.append(''.join(block_parts))
         
         # Log para debug
         logger.info(f"Mensagem dividida em {len(blocks)} partes:")
         for i, block in enumerate(blocks):
             logger.info(f"Parte {i+1}: {block[:50]}...")
         
-        # Envia as mensagens
+        # Envia as mensagens em sequência: a ordem das partes precisa ser mantida no chat
         for i, message in enumerate(blocks):
             logger.info(f"Enviando parte {i+1}/{len(blocks)}")
             
@@ -630,16 +826,12 @@ async def send_whatsapp_messages(response_text: str, phone: str, agent_id: str,
             
             if not success:
                 logger.error(f"Erro ao enviar mensagem {i+1}")
-                
-                # Pequena pausa entre mensagens
-                await asyncio.sleep(1)
         
         logger.info("Todas as mensagens foram enviadas com sucesso")
         return True
         
     except Exception as e:
-        logger.error(f"Erro ao dividir e enviar mensagens: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Erro ao dividir e enviar mensagens: %s", e)
         return False
 
 async def send_transfer_request(
@@ -654,23 +846,21 @@ async def send_transfer_request(
     try:
         # Busca o usuário responsável pelo assistente
         logger.info(f"Preparando transferência para humano. Agent ID: {agent_id}")
-        assistant_data = supabase.table('assistants').select(
-            'id, user_id'
-        ).eq('id', agent_id).execute()
+        assistant = await get_assistant_by_id(agent_id)
         
-        if not assistant_data.data or len(assistant_data.data) == 0:
+        if not assistant:
             logger.error(f"Assistente não encontrado: {agent_id}")
             return False
         
-        user_id = assistant_data.data[0]['user_id']
-        assistant_id = assistant_data.data[0]['id']
+        user_id = assistant['user_id']
+        assistant_id = assistant['id']
         
         logger.info(f"ID do assistente encontrado: {assistant_id}")
         
         # Busca o número de transferência na tabela agent_configurations
-        transfer_config = supabase.table('agent_configurations').select(
+        transfer_config = await supabase_execute(supabase.table('agent_configurations').select(
             'transfer_number'
-        ).eq('assistant_id', assistant_id).execute()
+        ).eq('assistant_id', assistant_id))
         
         if not transfer_config.data or len(transfer_config.data) == 0:
             logger.error(f"Configuração de transferência não encontrada para assistente: {assistant_id}")
@@ -681,32 +871,16 @@ async def send_transfer_request(
             
             # Formata o número conforme regra
             if transfer_number:
-                # Remove caracteres não numéricos
-                transfer_number = ''.join(filter(str.isdigit, transfer_number))
-                
-                # Verifica formato: DDD + 9 dígitos com 9 inicial -> remove o 9
-                if len(transfer_number) >= 3:  # Tem pelo menos DDD
-                    ddd = transfer_number[:2]
-                    numero = transfer_number[2:]
-                    
-                    if len(numero) == 9 and numero[0] == '9':
-                        numero = numero[1:]  # Remove o 9 inicial
-                        logger.info(f"Número após formatação: {ddd + numero}")
-                    
-                    transfer_number = ddd + numero
-                    
-                    # Adiciona código do país se não tiver
-                    if not transfer_number.startswith('55'):
-                        transfer_number = '55' + transfer_number
-                        logger.info(f"Número após adicionar código do país: {transfer_number}")
+                transfer_number = _format_br_phone(transfer_number)
         
         # Atualiza o status do contato para "cooldown"
         try:
-            supabase.table('contacts').update({
-                'status': 'cooldown',
-                'transfer_reason': reason,
-                'cooldown_until': (datetime.utcnow() + timedelta(hours=24)).isoformat()
-            }).eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).execute()
+            # O fim do cooldown é calculado pelo relógio do banco (função set_transfer_cooldown, em sql/functions.sql)
+            await supabase_execute(supabase.rpc('set_transfer_cooldown', {
+                'p_phone': phone,
+                'p_wid': quepasa_wid,
+                'p_reason': reason
+            }))
             logger.info(f"Status do contato {phone} atualizado para 'cooldown'")
         except Exception as e:
             logger.error(f"Erro ao atualizar status do contato: {str(e)}")
@@ -745,21 +919,18 @@ async def send_transfer_request(
         return True
         
     except Exception as e:
-        logger.error(f"Erro ao processar transferência: {str(e)}")
+        logger.exception("Erro ao processar transferência: %s", e)
         return False
 
 async def update_contact_stage(phone: str, stage: str, quepasa_wid: str) -> bool:
     """Atualiza o estágio do contato no banco de dados."""
     try:
-        data = supabase.table('contacts').update(
-            {"etapa": stage}
-        ).eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).execute()
+        await supabase_execute(supabase.table('contacts').update(
+            {"etapa": stage}, returning=ReturnMethod.minimal
+        ).eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid))
         
         logger.info(f"Estágio do contato {phone} atualizado para: {stage}")
         
-        # Adicionando log para verificar a resposta do Supabase
-        logger.info(f"Resposta do Supabase: {data}")
-        
         return True
     except Exception as e:
         logger.error(f"Erro ao atualizar estágio do contato: {str(e)}")
@@ -767,21 +938,39 @@ async def update_contact_stage(phone: str, stage: str, quepasa_wid: str) -> bool
         logger.error(f"Detalhes do erro: phone={phone}, stage={stage}")
         return False
 
-async def send_image(phone: str, agent_id: str, token: str, media_id: str) -> bool:
-    """Envia uma imagem para o usuário usando o ID da mídia do banco de dados."""
+async def get_media_link(media_id: str) -> Optional[str]:
+    """Busca o link da mídia pelo media_id, usando o cache de 1 hora.
+    Retorna None se não encontrar (resultado negativo não é guardado)."""
+    link = media_cache.get(media_id)
+    if link is None:
+        response = await supabase_execute(supabase.table('media').select('link').eq('media_id', media_id))
+        if not response.data:
+            return None
+        link = response.data[0]['link']
+        media_cache[media_id] = link
+    return link
+
+# Tipo MIME enviado ao Quepasa para cada tipo de mídia
+MIME_BY_KIND = {
+    'image': 'image/png',
+    'audio': 'audio/ogg',
+    'video': 'video/mp4'
+}
+
+async def send_media(phone: str, agent_id: str, token: str, media_id: str, kind: str) -> bool:
+    """Envia uma mídia (imagem, áudio ou vídeo) para o usuário usando o ID da mídia do banco de dados."""
     try:
-        # Busca a imagem no banco de dados
-        response = supabase.table('media').select('link').eq('media_id', media_id).execute()
+        # Busca a mídia no banco de dados (ou no cache)
+        media_link = await get_media_link(media_id)
         
-        if not response.data or len(response.data) == 0:
-            logger.error(f"Imagem não encontrada com ID: {media_id}")
+        if not media_link:
+            logger.error(f"Mídia ({kind}) não encontrada com ID: {media_id}")
             return False
             
-        image_link = response.data[0]['link']
-        logger.info(f"Link da imagem encontrado: {image_link}")
+        logger.info(f"Link da mídia ({kind}) encontrado: {media_link}")
         
         # Obtém o nome do arquivo a partir do link
-        filename = image_link.split('/')[-1]
+        filename = media_link.split('/')[-1]
         
         # Envia via QuepasaAPI
         success = await send_quepasa_message(
@@ -789,658 +978,579 @@ async def send_image(phone: str, agent_id: str, token: str, media_id: str) -> bo
             data={
                 "trackid": agent_id,
                 "text": "",
-                "mime": "image/png",
-                "url": image_link,
+                "mime": MIME_BY_KIND[kind],
+                "url": media_link,
                 "filename": filename
             },
             token=token
         )
                 
-        logger.info(f"Imagem enviada com sucesso para {phone}" if success else f"Falha ao enviar imagem para {phone}")
+        logger.info(f"Mídia ({kind}) enviada com sucesso para {phone}" if success else f"Falha ao enviar mídia ({kind}) para {phone}")
         return success
         
     except Exception as e:
-        logger.error(f"Erro ao enviar imagem: {str(e)}")
+        logger.error(f"Erro ao enviar mídia ({kind}): {str(e)}")
         return False
 
-async def send_audio(phone: str, agent_id: str, token: str, media_id: str) -> bool:
-    """Envia um áudio para o usuário usando o ID da mídia do banco de dados."""
+@dataclass(slots=True)
+class ToolContext:
+    """Dados da conversa usados pelas funções chamadas pelo assistente."""
+    phone: str
+    agent_id: str
+    token: str
+    quepasa_wid: str
+    chat_title: str
+    contact: Dict[str, Any]  # contato já carregado no início do processamento
+    # Serializa os envios de mídia de uma mesma rodada, mantendo a ordem pedida pelo assistente
+    media_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+async def handle_transfer(function_args: dict, ctx: ToolContext) -> Tuple[bool, str]:
+    """Função solicitar_transferencia: transfere o atendimento para um humano."""
+    # Usa o contato já carregado, sem nova ida ao banco
+    client_name = ctx.contact.get('name', 'Nome não disponível')
+    
+    # Obtém o motivo da transferência
+    reason = function_args.get('motivo', 'Não especificado')
+    
+    # Solicita a transferência
+    success = await send_transfer_request(
+        phone=ctx.phone,
+        client_name=client_name,
+        reason=reason,
+        agent_id=ctx.agent_id,
+        token=ctx.token,
+        quepasa_wid=ctx.quepasa_wid
+    )
+    
+    logger.info(f"Função solicitar_transferencia processada para {ctx.phone}: {reason}")
+    return success, "Transferência solicitada com sucesso" if success else "Falha ao solicitar transferência"
+
+async def handle_sales_funnel(function_args: dict, ctx: ToolContext) -> Tuple[bool, str]:
+    """Função funil_de_vendas: atualiza o estágio do contato."""
+    stage = function_args.get('estagio')
+    
+    # Atualiza o estágio do contato
+    success = await update_contact_stage(ctx.phone, stage, ctx.quepasa_wid)
+    
+    logger.info(f"Função funil_de_vendas processada para {ctx.phone}: {stage}")
+    return success, f"Contato atualizado para estágio: {stage}" if success else "Falha ao atualizar estágio"
+
+def media_tool_handler(kind: str, sent_message: str, failed_message: str):
+    """Cria o handler de uma função de envio de mídia (enviar_imagem, enviar_audio, enviar_video)."""
+    async def handle_media(function_args: dict, ctx: ToolContext) -> Tuple[bool, str]:
+        media_id = function_args.get('media_id')
+        
+        async with ctx.media_lock:
+            success = await send_media(
+                phone=ctx.phone,
+                agent_id=ctx.agent_id,
+                token=ctx.token,
+                media_id=media_id,
+                kind=kind
+            )
+        
+        logger.info(f"Função de envio de mídia ({kind}) processada para {ctx.phone}: {media_id}")
+        return success, sent_message if success else failed_message
+    return handle_media
+
+async def handle_appointment(function_args: dict, ctx: ToolContext) -> Tuple[bool, str]:
+    """Função agendamento: cria um evento na agenda do dono do assistente."""
+    # Obtém os dados do agendamento
+    title = function_args.get('title', '')
+    description = function_args.get('description', '')
+    customer_name = function_args.get('customer_name', '')
+    customer_contact = function_args.get('customer_contact', '')
+    appointment_date = function_args.get('appointment_date', '')
+    appointment_time = function_args.get('appointment_time', '')
+    end_time = function_args.get('end_time', '')
+    location = function_args.get('location', '')
+    service_type = function_args.get('service_type', '')
+    status = function_args.get('status', 'agendado')
+    notes = function_args.get('notes', '')
+    
     try:
-        # Busca o áudio no banco de dados
-        response = supabase.table('media').select('link').eq('media_id', media_id).execute()
+        # Formatar data e hora para o formato ISO
+        start_datetime = f"{appointment_date}T{appointment_time}:00"
+        end_datetime = f"{appointment_date}T{end_time}:00" if end_time else None
+        
+        # O dono do agendamento é o dono do assistente (busca em cache pelo id)
+        assistant = await get_assistant_by_id(ctx.agent_id)
+        if not assistant or not assistant.get('user_id'):
+            raise Exception(f"Assistente sem user_id para agendamento: {ctx.agent_id}")
+        user_id = assistant['user_id']
+        
+        # Dados do agendamento
+        appointment_data = {
+            'title': title,
+            'description': description or f"Agendamento para {customer_name}",
+            'start_time': start_datetime,
+            'end_time': end_datetime,
+            'status': status,
+            'location': location
+        }
         
-        if not response.data or len(response.data) == 0:
-            logger.error(f"Áudio não encontrado com ID: {media_id}")
-            return False
+        # Adiciona notas ao description se existirem
+        if notes:
+            appointment_data['description'] += f"\nObservações: {notes}"
             
-        audio_link = response.data[0]['link']
-        logger.info(f"Link do áudio encontrado: {audio_link}")
-        
-        # Obtém o nome do arquivo a partir do link
-        filename = audio_link.split('/')[-1]
-        
-        # Envia via QuepasaAPI
-        success = await send_quepasa_message(
-            phone=phone,
-            data={
-                "trackid": agent_id,
-                "text": "",
-                "mime": "audio/ogg",
-                "url": audio_link,
-                "filename": filename
-            },
-            token=token
-        )
-                
-        logger.info(f"Áudio enviado com sucesso para {phone}" if success else f"Falha ao enviar áudio para {phone}")
-        return success
-        
+        # Adiciona serviço ao description se existir
+        if service_type:
+            appointment_data['description'] += f"\nServiço: {service_type}"
+            
+        # Adiciona dados do cliente ao description
+        appointment_data['description'] += f"\nCliente: {customer_name}"
+        appointment_data['description'] += f"\nContato: {customer_contact or ctx.phone}"
+        
+        now = datetime.now(timezone.utc).isoformat()
+        appointment_data.update({
+            'contact_id': ctx.contact['id'],
+            'user_id': user_id,
+            'created_at': now,
+            'updated_at': now
+        })
+        
+        # Insere o agendamento no banco de dados
+        await supabase_execute(supabase.table('calendar_events').insert(appointment_data, returning=ReturnMethod.minimal))
+        
+        success = True
+        logger.info(f"Agendamento criado com sucesso para {ctx.phone}: {title} em {start_datetime}")
     except Exception as e:
-        logger.error(f"Erro ao enviar áudio: {str(e)}")
-        return False
-
-async def send_video(phone: str, agent_id: str, token: str, media_id: str) -> bool:
-    """Envia um vídeo para o usuário usando o ID da mídia do banco de dados."""
+        logger.error(f"Erro ao criar agendamento: {str(e)}")
+        success = False
+    
+    logger.info(f"Função agendamento processada para {ctx.phone}")
+    return success, "Agendamento criado com sucesso" if success else "Falha ao criar agendamento"
+
+# Funções do assistente tratadas localmente; as demais são repassadas ao webhook
+TOOL_HANDLERS = {
+    'solicitar_transferencia': handle_transfer,
+    'funil_de_vendas': handle_sales_funnel,
+    'enviar_imagem': media_tool_handler('image', "Imagem enviada com sucesso", "Falha ao enviar imagem"),
+    'enviar_audio': media_tool_handler('audio', "Áudio enviado com sucesso", "Falha ao enviar áudio"),
+    'enviar_video': media_tool_handler('video', "Vídeo enviado com sucesso", "Falha ao enviar vídeo"),
+    'agendamento': handle_appointment
+}
+
+async def run_tool_call(tool_call, ctx: ToolContext) -> Dict[str, str]:
+    """Executa uma função pedida pelo assistente e monta a resposta para submit_tool_outputs."""
+    function_name = tool_call.function.name
+    logger.info("Processando função: %s", function_name)
+    
     try:
-        # Busca o vídeo no banco de dados
-        response = supabase.table('media').select('link').eq('media_id', media_id).execute()
-        
-        if not response.data or len(response.data) == 0:
-            logger.error(f"Vídeo não encontrado com ID: {media_id}")
-            return False
-            
-        video_link = response.data[0]['link']
-        logger.info(f"Link do vídeo encontrado: {video_link}")
-        
-        # Obtém o nome do arquivo a partir do link
-        filename = video_link.split('/')[-1]
+        function_args = orjson.loads(tool_call.function.arguments)
         
-        # Envia via QuepasaAPI
-        success = await send_quepasa_message(
-            phone=phone,
-            data={
-                "trackid": agent_id,
-                "text": "",
-                "mime": "video/mp4",
-                "url": video_link,
-                "filename": filename
-            },
-            token=token
-        )
-                
-        logger.info(f"Vídeo enviado com sucesso para {phone}" if success else f"Falha ao enviar vídeo para {phone}")
-        return success
+        handler = TOOL_HANDLERS.get(function_name)
+        if handler:
+            success, message = await handler(function_args, ctx)
+        else:
+            # Para qualquer outra função, envia para o webhook
+            logger.info("Enviando função %s para webhook", function_name)
+            success = await send_webhook_request(function_name, function_args)
+            message = f"Webhook chamado para função: {function_name}"
         
+        output = {"success": success, "message": message}
     except Exception as e:
-        logger.error(f"Erro ao enviar vídeo: {str(e)}")
-        return False
+        logger.error("Erro ao processar função %s: %s", function_name, e)
+        output = {"success": False, "error": str(e)}
+    
+    return {
+        "tool_call_id": tool_call.id,
+        "output": orjson.dumps(output).decode()
+    }
 
-async def process_delayed_message(phone: str, agent_id: str, token: str, quepasa_wid: str, openai_assistant_id: str, chat_title: str):
-    # Define a chave única no início da função
-    key = f"{phone}:{agent_id}"
+# Tempo máximo para uma run do assistente terminar, incluindo as rodadas de funções
+RUN_TIMEOUT_SECONDS = 300
+
+# Tempo máximo para processar um lote de mensagens de um contato (run do assistente,
+# Supabase e envio pelo Quepasa). Maior que RUN_TIMEOUT_SECONDS para a run expirar primeiro
+BATCH_TIMEOUT_SECONDS = RUN_TIMEOUT_SECONDS + 60
+
+# Estados de run que impedem adicionar mensagens à thread
+ACTIVE_RUN_STATUSES = ('queued', 'in_progress', 'requires_action')
+
+async def cancel_active_runs(thread_id: str):
+    """Cancela ao mesmo tempo todas as runs ativas da thread e espera que parem."""
+    # Uma thread só tem uma run ativa por vez, e ela é sempre a mais recente
+    runs = await openai_client.beta.threads.runs.list(thread_id=thread_id, limit=1, order='desc')
+    active_runs = [run for run in runs.data if run.status in ACTIVE_RUN_STATUSES]
+    if not active_runs:
+        return
     
-    try:
-        # Espera 5 segundos
-        await asyncio.sleep(5)
-        
-        # Verifica se ainda existem mensagens pendentes para este contato
-        if key not in pending_messages:
-            logger.info(f"Nenhuma mensagem pendente encontrada para {key}")
-            return
-            
-        # Obtém todas as mensagens acumuladas
-        messages = pending_messages.pop(key, [])
-        if not messages:
-            return
-            
-        # Concatena as mensagens
-        concatenated_message = " ".join([msg for msg in messages])
-        logger.info(f"Processando {len(messages)} mensagens concatenadas para {phone}")
-        
-        # Processa a mensagem concatenada
-        contact = await check_and_create_contact(phone, quepasa_wid, "", False, chat_title)
-        
-        if not contact:
-            logger.info(f"Contato {phone} não encontrado")
-            return
-            
-        if contact['status'] in ['cooldown', 'pausado']:
-            logger.info(f"Contato {phone} está {contact['status']}")
+    for run in active_runs:
+        logger.info("Cancelando run ativa: %s", run.id)
+    cancelled = await asyncio.gather(*(
+        openai_client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+        for run in active_runs
+    ), return_exceptions=True)
+    
+    # Aguarda as runs saírem dos estados ativos (no máximo ~5 segundos).
+    # A resposta do cancel já traz o estado da run, então só consulta de novo as que ainda não pararam
+    stopping_statuses = ACTIVE_RUN_STATUSES + ('cancelling',)
+    pending_ids = [run.id for run in cancelled if not isinstance(run, Exception) and run.status in stopping_statuses]
+    for _ in range(10):
+        if not pending_ids:
             return
-            
-        # Verifica se a thread existente é válida ou se precisa criar uma nova
-        thread_id = contact.get('thread_id')
-        if not thread_id:
-            # Cria uma nova thread se thread_id for nulo
-            logger.info(f"Thread ID nula para o contato {phone}. Criando nova thread...")
-            thread = openai_client.beta.threads.create()
-            thread_id = thread.id
-            
-            # Atualiza o contato com a nova thread_id
+        await asyncio.sleep(0.5)
+        runs = await asyncio.gather(*(
+            openai_client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+            for run_id in pending_ids
+        ))
+        pending_ids = [run.id for run in runs if run.status in stopping_statuses]
+    
+    if pending_ids:
+        logger.warning("Runs ainda ativas após o cancelamento: %s", pending_ids)
+
+async def follow_run_stream(stream_manager):
+    """Consome os eventos de uma run em streaming até ela parar.
+    Retorna a run no estado final e o texto da última mensagem concluída, se houver."""
+    message_text = None
+    async with stream_manager as stream:
+        async for event in stream:
+            if event.event == 'thread.message.completed':
+                message_text = event.data.content[0].text.value
+        return stream.current_run, message_text
+
+async def run_assistant(thread_id: str, openai_assistant_id: str, tool_context: ToolContext) -> Tuple[Optional[str], bool]:
+    """Executa o assistente na thread, atendendo as funções que ele chamar.
+    Retorna o texto da resposta (None se a run falhar) e se alguma função foi chamada."""
+    # Executa o assistente usando o ID correto do OpenAI.
+    # A run é acompanhada por streaming (SSE): os eventos chegam pela mesma conexão, sem polling
+    logger.info("Executando assistente com ID OpenAI: %s", openai_assistant_id)
+    stream_manager = openai_client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=openai_assistant_id  # Usa o ID do assistente na OpenAI (formato asst_XXX)
+    )
+    response_text = None
+    used_tools = False
+    
+    # Limite de tempo total da run, somando todas as rodadas de funções
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RUN_TIMEOUT_SECONDS
+    
+    while True:
+        try:
+            run, message_text = await asyncio.wait_for(
+                follow_run_stream(stream_manager),
+                timeout=deadline - loop.time()
+            )
+        except asyncio.TimeoutError:
+            logger.error("Timeout ao processar mensagem")
+            # A run continua na OpenAI; cancela para liberar a thread para o próximo lote
             try:
-                supabase.table('contacts').update({
-                    'thread_id': thread_id
-                }).eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).execute()
-                logger.info(f"Contato {phone} atualizado com nova thread_id: {thread_id}")
+                await asyncio.wait_for(cancel_active_runs(thread_id), timeout=15)
             except Exception as e:
-                logger.error(f"Erro ao atualizar thread_id do contato: {str(e)}")
+                logger.error("Erro ao cancelar run: %s", e)
+            return None, used_tools
+        if message_text:
+            response_text = message_text
+        
+        if run.status == 'requires_action' and run.required_action.type == 'submit_tool_outputs':
+            used_tools = True
+            # Executa as funções da rodada ao mesmo tempo; as respostas saem na ordem das chamadas
+            tool_outputs = await asyncio.gather(*(
+                run_tool_call(tool_call, tool_context)
+                for tool_call in run.required_action.submit_tool_outputs.tool_calls
+            ))
+            
+            # Submete todas as respostas das funções e continua acompanhando a mesma run
+            logger.debug("Submetendo resultados das funções: %s", tool_outputs)
+            stream_manager = openai_client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=thread_id,
+                run_id=run.id,
+                tool_outputs=tool_outputs
+            )
+            continue
         
-        # Antes de criar uma nova mensagem, verifica e cancela runs ativas
+        break
+    
+    # Se falhou, cancelado, expirou ou ficou incompleto, gera mensagem de erro
+    if run.status == 'incomplete':
+        logger.error("Assistente falhou: %s (%s)", run.status, run.incomplete_details)
+        return None, used_tools
+    if run.status != 'completed':
+        logger.error("Assistente falhou: %s", run.status)
+        return None, used_tools
+    
+    if not response_text:
+        logger.error("Assistente concluiu sem retornar mensagem")
+    return response_text, used_tools
+
+# Mensagem enviada ao assistente: dados do cliente seguidos das mensagens recebidas
+PROMPT_TMPL = (
+    "\n"
+    "INFORMAÇÕES DO CLIENTE:\n"
+    "Número: {phone}\n"
+    "Nome: {name}\n"
+    "Data atual: {date} \n"
+    "Hora atual (Brasília): {time}\n"
+    "\n"
+    "MENSAGEM:\n"
+    "{message}\n"
+)
+
+async def process_message_batch(messages: list, phone: str, agent_id: str, token: str, quepasa_wid: str, openai_assistant_id: str, chat_title: str):
+    """Envia ao assistente as mensagens acumuladas de um contato e responde pelo WhatsApp."""
+    # Concatena as mensagens, uma por linha, em uma única mensagem para a thread
+    concatenated_message = "\n".join(messages)
+    logger.info("Processando %s mensagens concatenadas para %s", len(messages), phone)
+
+    # Processa a mensagem concatenada
+    contact = await check_and_create_contact(phone, quepasa_wid, "", False, chat_title)
+
+    if not contact:
+        logger.info("Contato %s não encontrado", phone)
+        return
+    
+    if contact['status'] in ['cooldown', 'pausado']:
+        logger.info("Contato %s está %s", phone, contact['status'])
+        return
+    
+    # Verifica se a thread existente é válida ou se precisa criar uma nova
+    thread_id = contact.get('thread_id')
+    if not thread_id:
+        # Cria uma nova thread se thread_id for nulo
+        logger.info("Thread ID nula para o contato %s. Criando nova thread...", phone)
+        thread = await openai_client.beta.threads.create()
+        thread_id = thread.id
+    
+        # Atualiza o contato com a nova thread_id
         try:
-            runs = openai_client.beta.threads.runs.list(thread_id=thread_id)
-            for run in runs.data:
-                if run.status in ['in_progress', 'queued', 'requires_action']:
-                    logger.info(f"Cancelando run ativa: {run.id}")
-                    openai_client.beta.threads.runs.cancel(
-                        thread_id=thread_id,
-                        run_id=run.id
-                    )
-                    await asyncio.sleep(1)  # Pequena pausa para garantir que o cancelamento foi processado
+            await supabase_execute(supabase.table('contacts').update({
+                'thread_id': thread_id
+            }, returning=ReturnMethod.minimal).eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid))
+            logger.info("Contato %s atualizado com nova thread_id: %s", phone, thread_id)
         except Exception as e:
-            logger.error(f"Erro ao cancelar run: {str(e)}")
-
-        # Agora podemos adicionar a nova mensagem com segurança
-        # Adiciona informações de contexto do cliente
-        brasilia_tz = pytz.timezone('America/Sao_Paulo')
-        now = datetime.now(brasilia_tz)
-        date_str = now.strftime("%d/%m/%Y")
-        time_str = now.strftime("%H:%M:%S")
-        
-        # Adiciona cabeçalho com informações do cliente à mensagem
-        contact_info = f"""
-INFORMAÇÕES DO CLIENTE:
-Número: {phone}
-Nome: {chat_title or "Não informado"}
-Data atual: {date_str} 
-Hora atual (Brasília): {time_str}
-
-MENSAGEM:
-{concatenated_message}
-"""
-        
-        thread_message = openai_client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=contact_info
-        )
-        logger.info(f"Mensagens concatenadas adicionadas à thread: {thread_message.id}")
-        
-        # Executa o assistente usando o ID correto do OpenAI
-        logger.info(f"Executando assistente com ID OpenAI: {openai_assistant_id}")
-        run = openai_client.beta.threads.runs.create(
+            logger.error("Erro ao atualizar thread_id do contato: %s", e)
+
+    # Antes de criar uma nova mensagem, verifica e cancela runs ativas
+    try:
+        await cancel_active_runs(thread_id)
+    except Exception as e:
+        logger.error("Erro ao cancelar run: %s", e)
+
+    # Agora podemos adicionar a nova mensagem com segurança
+    # Adiciona informações de contexto do cliente
+    now = datetime.now(BRASILIA_TZ)
+    date_str = now.strftime("%d/%m/%Y")
+    time_str = now.strftime("%H:%M:%S")
+
+    # Adiciona cabeçalho com informações do cliente à mensagem
+    contact_info = PROMPT_TMPL.format_map({
+        'phone': phone,
+        'name': chat_title or "Não informado",
+        'date': date_str,
+        'time': time_str,
+        'message': concatenated_message
+    })
+
+    thread_message = await openai_client.beta.threads.messages.create(
+        thread_id=thread_id,
+        role="user",
+        content=contact_info
+    )
+    logger.info("Mensagens concatenadas adicionadas à thread: %s", thread_message.id)
+
+    # Dados da conversa para as funções que o assistente pode chamar
+    tool_context = ToolContext(
+        phone=phone,
+        agent_id=agent_id,
+        token=token,
+        quepasa_wid=quepasa_wid,
+        chat_title=chat_title,
+        contact=contact
+    )
+
+    # Cache opcional de respostas para mensagens repetidas (RESPONSE_CACHE_TTL)
+    cache_key = None
+    response_text = None
+    if response_cache is not None:
+        cache_key = hashlib.blake2b(f"{openai_assistant_id}|{concatenated_message}".encode(), digest_size=16).hexdigest()
+        response_text = response_cache.get(cache_key)
+
+    if response_text:
+        logger.info("Resposta encontrada no cache, sem executar o assistente")
+        # Registra a resposta na thread para manter o histórico da conversa
+        await openai_client.beta.threads.messages.create(
             thread_id=thread_id,
-            assistant_id=openai_assistant_id  # Usa o ID do assistente na OpenAI (formato asst_XXX)
+            role="assistant",
+            content=response_text
         )
-        
-        # Adiciona timeout e tratamento de estados de erro
-        max_retries = 30
-        retry_count = 0
-        
+    else:
+        response_text, used_tools = await run_assistant(thread_id, openai_assistant_id, tool_context)
+        if not response_text:
+            return
+        # Só guarda respostas que não chamaram funções (envio de mídia, transferência, agendamento...)
+        if cache_key and not used_tools:
+            response_cache[cache_key] = response_text
+
+    logger.info("Resposta completa do assistente: %s...", response_text[:200])
+
+    # Agora vamos dividir e enviar as mensagens
+    logger.info("Iniciando divisão e envio de mensagens...")
+    success = await send_whatsapp_messages(
+        response_text=response_text,
+        phone=phone,
+        agent_id=agent_id,
+        token=token
+    )
+
+    if success:
+        logger.info("Todas as mensagens foram enviadas com sucesso")
+    else:
+        logger.error("Falha ao enviar mensagens")
+
+async def process_delayed_message(phone: str, agent_id: str, token: str, quepasa_wid: str, openai_assistant_id: str, chat_title: str):
+    """Consome a fila de mensagens do contato: espera 5 segundos para agrupar as mensagens
+    seguidas e processa o lote; repete enquanto chegarem mensagens novas durante o processamento."""
+    # Define a chave única no início da função
+    key = f"{phone}:{agent_id}"
+    slot = message_slots[key]
+    
+    try:
         while True:
-            run = openai_client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run.id
-            )
-            
-            if run.status == 'requires_action' and run.required_action.type == 'submit_tool_outputs':
-                tool_outputs = []
-                
-                for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                    function_name = tool_call.function.name
-                    logger.info(f"Processando função: {function_name}")
-                    
-                    try:
-                        function_args = json.loads(tool_call.function.arguments)
-                        
-                        if function_name == 'solicitar_transferencia':
-                            # Obtém informações do contato
-                            contact = await check_and_create_contact(phone, quepasa_wid, "", False, chat_title)
-                            client_name = contact.get('name', 'Nome não disponível')
-                            
-                            # Obtém o motivo da transferência
-                            reason = function_args.get('motivo', 'Não especificado')
-                            
-                            # Solicita a transferência
-                            success = await send_transfer_request(
-                                phone=phone,
-                                client_name=client_name,
-                                reason=reason,
-                                agent_id=agent_id,
-                                token=token,
-                                quepasa_wid=quepasa_wid
-                            )
-                            
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps({
-                                    "success": success,
-                                    "message": "Transferência solicitada com sucesso" if success else "Falha ao solicitar transferência"
-                                })
-                            })
-                            
-                            logger.info(f"Função solicitar_transferencia processada para {phone}: {reason}")
-                            
-                        elif function_name == 'funil_de_vendas':
-                            stage = function_args.get('estagio')
-                            
-                            # Atualiza o estágio do contato
-                            success = await update_contact_stage(phone, stage, quepasa_wid)
-                            
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps({
-                                    "success": success,
-                                    "message": f"Contato atualizado para estágio: {stage}" if success else "Falha ao atualizar estágio"
-                                })
-                            })
-                            
-                            logger.info(f"Função funil_de_vendas processada para {phone}: {stage}")
-                            
-                        elif function_name == 'enviar_imagem':
-                            media_id = function_args.get('media_id')
-                            
-                            # Envia a imagem
-                            success = await send_image(
-                                phone=phone,
-                                agent_id=agent_id,
-                                token=token,
-                                media_id=media_id
-                            )
-                            
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps({
-                                    "success": success,
-                                    "message": f"Imagem enviada com sucesso" if success else "Falha ao enviar imagem"
-                                })
-                            })
-                            
-                            logger.info(f"Função enviar_imagem processada para {phone}: {media_id}")
-                            
-                        elif function_name == 'enviar_audio':
-                            media_id = function_args.get('media_id')
-                            
-                            # Envia o áudio
-                            success = await send_audio(
-                                phone=phone,
-                                agent_id=agent_id,
-                                token=token,
-                                media_id=media_id
-                            )
-                            
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps({
-                                    "success": success,
-                                    "message": f"Áudio enviado com sucesso" if success else "Falha ao enviar áudio"
-                                })
-                            })
-                            
-                            logger.info(f"Função enviar_audio processada para {phone}: {media_id}")
-                            
-                        elif function_name == 'enviar_video':
-                            media_id = function_args.get('media_id')
-                            
-                            # Envia o vídeo
-                            success = await send_video(
-                                phone=phone,
-                                agent_id=agent_id,
-                                token=token,
-                                media_id=media_id
-                            )
-                            
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps({
-                                    "success": success,
-                                    "message": f"Vídeo enviado com sucesso" if success else "Falha ao enviar vídeo"
-                                })
-                            })
-                            
-                            logger.info(f"Função enviar_video processada para {phone}: {media_id}")
-                        
-                        elif function_name == 'agendamento':
-                            # Obtém os dados do agendamento
-                            title = function_args.get('title', '')
-                            description = function_args.get('description', '')
-                            customer_name = function_args.get('customer_name', '')
-                            customer_contact = function_args.get('customer_contact', '')
-                            appointment_date = function_args.get('appointment_date', '')
-                            appointment_time = function_args.get('appointment_time', '')
-                            end_time = function_args.get('end_time', '')
-                            location = function_args.get('location', '')
-                            service_type = function_args.get('service_type', '')
-                            status = function_args.get('status', 'agendado')
-                            notes = function_args.get('notes', '')
-                            
-                            try:
-                                # Obtém o user_id do assistente - tentando várias abordagens
-                                logger.info(f"DEBUG - Tentando obter user_id para assistente_id: {agent_id}")
-                                
-                                # Primeiro, tenta buscar pelo id do assistente (caso seja o id da tabela)
-                                logger.info(f"DEBUG - Tentativa 1: Buscando pelo id na tabela")
-                                assistant_response = supabase.table('assistants').select('*').eq('id', agent_id).execute()
-                                
-                                # Se não encontrar, tenta pelo assistant_id
-                                if not assistant_response.data or len(assistant_response.data) == 0:
-                                    logger.info(f"DEBUG - Tentativa 2: Buscando pelo assistant_id")
-                                    assistant_response = supabase.table('assistants').select('*').eq('assistant_id', agent_id).execute()
-                                
-                                # Se ainda não encontrar, tenta buscar pelo token (que às vezes é usado como assistant_id)
-                                if not assistant_response.data or len(assistant_response.data) == 0:
-                                    logger.info(f"DEBUG - Tentativa 3: Buscando pelo token")
-                                    assistant_response = supabase.table('assistants').select('*').eq('token', agent_id).execute()
-                                
-                                # Se ainda não encontrar, tenta buscar assistentes que tenham o mesmo domínio no token
-                                if not assistant_response.data or len(assistant_response.data) == 0:
-                                    logger.info(f"DEBUG - Tentativa 4: Buscando pelo domínio Quepasa")
-                                    assistant_response = supabase.table('assistants').select('*').eq('x-quepasa-wid', quepasa_wid).execute()
-                                
-                                # Final fallback - obtém qualquer assistente
-                                if not assistant_response.data or len(assistant_response.data) == 0:
-                                    logger.info(f"DEBUG - Tentativa 5: Buscando qualquer assistente")
-                                    assistant_response = supabase.table('assistants').select('*').limit(1).execute()
-                                    
-                                    if not assistant_response.data or len(assistant_response.data) == 0:
-                                        logger.error(f"DEBUG - Não foi possível encontrar nenhum assistente")
-                                        # Usando UUID fixo como último recurso
-                                        logger.info(f"DEBUG - Último recurso: Usando UUID fixo")
-                                        user_id = '0b411149-a240-4eb7-ba94-920f6be08bb9'  # ID que vimos na imagem
-                                    else:
-                                        logger.info(f"DEBUG - Encontrado um assistente como fallback: {assistant_response.data[0]}")
-                                        user_id = assistant_response.data[0]['user_id']
-                                else:
-                                    logger.info(f"DEBUG - Assistente encontrado: {assistant_response.data[0]}")
-                                    user_id = assistant_response.data[0]['user_id']
-                                
-                                logger.info(f"DEBUG - User ID final para agendamento: {user_id}")
-                                
-                                # Obtém o contact_id do contato atual
-                                contact_response = supabase.table('contacts').select('id').eq('whatsapp', phone).eq('x-quepasa-wid', quepasa_wid).execute()
-                                
-                                if not contact_response.data or len(contact_response.data) == 0:
-                                    logger.error(f"Contato não encontrado para agendamento: {phone}")
-                                    raise Exception("Contato não encontrado")
-                                
-                                contact_id = contact_response.data[0]['id']
-                                logger.info(f"DEBUG - Contact ID para agendamento: {contact_id}")
-                                
-                                # Formatar data e hora para o formato ISO
-                                start_datetime = f"{appointment_date}T{appointment_time}:00"
-                                end_datetime = f"{appointment_date}T{end_time}:00" if end_time else None
-                                
-                                # Insere o agendamento no banco de dados com as colunas corretas
-                                appointment_data = {
-                                    'title': title,
-                                    'description': description or f"Agendamento para {customer_name}",
-                                    'start_time': start_datetime,
-                                    'end_time': end_datetime,
-                                    'status': status,
-                                    'location': location,
-                                    'contact_id': contact_id,
-                                    'user_id': user_id,  # Adiciona o user_id
-                                    'created_at': datetime.utcnow().isoformat(),
-                                    'updated_at': datetime.utcnow().isoformat()
-                                }
-                                
-                                # Adiciona notas ao description se existirem
-                                if notes:
-                                    appointment_data['description'] += f"\nObservações: {notes}"
-                                    
-                                # Adiciona serviço ao description se existir
-                                if service_type:
-                                    appointment_data['description'] += f"\nServiço: {service_type}"
-                                    
-                                # Adiciona dados do cliente ao description
-                                appointment_data['description'] += f"\nCliente: {customer_name}"
-                                appointment_data['description'] += f"\nContato: {customer_contact or phone}"
-                                
-                                # Realiza a inserção no banco
-                                response = supabase.table('calendar_events').insert(appointment_data).execute()
-                                
-                                success = True
-                                logger.info(f"Agendamento criado com sucesso para {phone}: {title} em {start_datetime}")
-                            except Exception as e:
-                                logger.error(f"Erro ao criar agendamento: {str(e)}")
-                                success = False
-                            
-                            # Retorna o resultado
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps({
-                                    "success": success,
-                                    "message": "Agendamento criado com sucesso" if success else "Falha ao criar agendamento"
-                                })
-                            })
-                            
-                            logger.info(f"Função agendamento processada para {phone}")
-                            
-                        else:
-                            # Para qualquer outra função, envia para o webhook
-                            logger.info(f"Enviando função {function_name} para webhook")
-                            success = await send_webhook_request(function_name, function_args)
-                            
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": json.dumps({
-                                    "success": success,
-                                    "message": f"Webhook chamado para função: {function_name}"
-                                })
-                            })
-                            
-                    except Exception as e:
-                        logger.error(f"Erro ao processar função {function_name}: {str(e)}")
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps({"success": False, "error": str(e)})
-                        })
-                
-                # Submete todas as respostas das funções
-                if tool_outputs:
-                    logger.info(f"Submetendo resultados das funções: {tool_outputs}")
-                    run = openai_client.beta.threads.runs.submit_tool_outputs(
-                        thread_id=thread_id,
-                        run_id=run.id,
-                        tool_outputs=tool_outputs
-                    )
+            # Espera 5 segundos
+            await asyncio.sleep(5)
             
-            # Se concluído com sucesso, sai do loop
-            if run.status == 'completed':
-                break
-                
-            # Se falhou, cancelado ou expirou, gera mensagem de erro
-            if run.status in ['failed', 'cancelled', 'expired']:
-                logger.error(f"Assistente falhou: {run.status}")
+            # Obtém todas as mensagens acumuladas
+            messages = []
+            while not slot.queue.empty() and (not MESSAGE_BATCH_MAX or len(messages) < MESSAGE_BATCH_MAX):
+                messages.append(slot.queue.get_nowait())
+            if not messages:
+                logger.info("Nenhuma mensagem pendente encontrada para %s", key)
                 return
             
-            # Limita o número de tentativas
-            retry_count += 1
-            if retry_count >= max_retries:
-                logger.error("Timeout ao processar mensagem")
-                return
+            # Limite de tempo para todo o processamento do lote, para que uma chamada
+            # travada (OpenAI, Supabase ou Quepasa) não prenda a fila do contato
+            try:
+                await asyncio.wait_for(
+                    process_message_batch(messages, phone, agent_id, token, quepasa_wid, openai_assistant_id, chat_title),
+                    timeout=BATCH_TIMEOUT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                logger.error("Processamento do lote de %s excedeu %s segundos", key, BATCH_TIMEOUT_SECONDS)
+            except Exception as e:
+                # Um lote com erro não pode deixar as mensagens seguintes presas na fila
+                logger.exception("Erro ao processar mensagem com delay: %s", e)
             
-            # Aguarda antes de verificar novamente
-            await asyncio.sleep(2)
-        
-        messages = openai_client.beta.threads.messages.list(thread_id=thread_id)
-        response_text = messages.data[0].content[0].text.value
-        logger.info(f"Resposta completa do assistente: {response_text[:200]}...")
-        
-        # Agora vamos dividir e enviar as mensagens
-        logger.info("Iniciando divisão e envio de mensagens...")
-        success = await send_whatsapp_messages(
-            response_text=response_text,
-            phone=phone,
-            agent_id=agent_id,
-            token=token
-        )
-        
-        if success:
-            logger.info("Todas as mensagens foram enviadas com sucesso")
-        else:
-            logger.error("Falha ao enviar mensagens")
+            # Mensagens que chegaram durante o processamento formam o próximo lote
+            if slot.queue.empty():
+                return
             
     except asyncio.CancelledError:
-        logger.info(f"Tarefa cancelada para {key}")
-        # Limpa a tarefa dos pendentes se existir
-        if key in pending_tasks:
-            del pending_tasks[key]
+        logger.info("Tarefa cancelada para %s", key)
         raise  # Re-levanta a exceção para proper cleanup
-            
-    except Exception as e:
-        logger.error(f"Erro ao processar mensagem com delay: {str(e)}")
-        traceback.print_exc()  # Adiciona rastreamento completo do erro
-    finally:
-        # Limpa a tarefa pendente em qualquer caso
-        if key in pending_tasks:
-            del pending_tasks[key]
 
 @app.post("/webhook")
 async def webhook(request: Request, x_quepasa_wid: str = Header(None, alias="x-quepasa-wid")):
+    msg = None
     try:
         # Lê o corpo da requisição
-        body = await request.json()
+        body = orjson.loads(await request.body())
         
-        # Verifica se o corpo está dentro de um objeto 'body'
-        if 'body' in body:
-            message_data = body['body']
-        else:
-            message_data = body
-            
-        # Cria o objeto QuepasaMessage
-        message = QuepasaMessage(
-            id=message_data['id'],
-            timestamp=message_data['timestamp'],
-            type=message_data['type'],
-            chat=ChatInfo(
-                id=message_data['chat']['id'],
-                title=message_data['chat'].get('title')
-            ),
-            text=message_data.get('text'),
-            fromme=str(message_data.get('fromme', 'false')).lower() == 'true',
-            frominternal=str(message_data.get('frominternal', 'false')).lower() == 'true'
-        )
+        # Valida a mensagem, que pode vir dentro de um objeto 'body'
+        message = QuepasaMessage.model_validate(body.get('body', body))
+        msg = WebhookMsg.from_quepasa(message)
         
         # Log detalhado da requisição recebida
         logger.info("=== NOVA REQUISIÇÃO WEBHOOK ===")
-        logger.info(f"Headers recebidos: x-quepasa-wid={x_quepasa_wid}")
-        logger.info(f"Corpo processado: {message.model_dump_json()}")
+        logger.info("Headers recebidos: x-quepasa-wid=%s", x_quepasa_wid)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Corpo processado: %s", message.model_dump_json())
         
         # Extrai informações da mensagem
-        message_id = message.id
-        message_type = message.type
+        message_id = msg.message_id
+        message_type = msg.message_type
         
-        logger.info(f"Tipo de mensagem: {message_type}")
-        logger.info(f"ID da mensagem: {message_id}")
+        logger.info("Tipo de mensagem: %s", message_type)
+        logger.info("ID da mensagem: %s", message_id)
         
         # Extrai número do telefone e nome do chat
-        phone = message.chat.id.split('@')[0]
-        push_name = message.chat.title or f"User {phone}"
+        phone = msg.phone
+        push_name = msg.chat_title or f"User {phone}"
         
-        logger.info(f"Número do telefone: {phone}")
-        logger.info(f"Nome do chat: {push_name}")
+        logger.info("Número do telefone: %s", phone)
+        logger.info("Nome do chat: %s", push_name)
         
         # Trata o campo fromme
-        from_me = message.fromme
-        logger.info(f"From me: {from_me}")
+        from_me = msg.from_me
+        logger.info("From me: %s", from_me)
         
         # Limpa o número de telefone removendo tudo após os dois pontos
         if ':' in x_quepasa_wid:
             x_quepasa_wid = x_quepasa_wid.split(':')[0]
-            logger.info(f"Número de telefone limpo para busca: {x_quepasa_wid}")
+            logger.info("Número de telefone limpo para busca: %s", x_quepasa_wid)
         
         if not x_quepasa_wid:
             logger.error("Cabeçalho x-quepasa-wid não encontrado na requisição")
             return {"success": False, "message": "Header x-quepasa-wid ausente"}
         
-        # Busca o assistente pelo x-quepasa-wid primeiro
-        response = supabase.table('assistants').select('id, token, assistant_id').eq('x-quepasa-wid', x_quepasa_wid).execute()
-
-        if not response.data or len(response.data) == 0:
-            logger.error(f"Nenhum assistente encontrado para x-quepasa-wid: {x_quepasa_wid}")
-            # Tenta buscar todos os assistentes para debug
-            all_assistants = supabase.table('assistants').select('id, token, assistant_id').execute()
-            logger.info(f"Assistentes disponíveis: {len(all_assistants.data) if all_assistants.data else 0}")
-            
-            if all_assistants.data:
-                logger.info(f"Colunas disponíveis: {list(all_assistants.data[0].keys())}")
-                
-                # Verificar se existe um assistente para este x-quepasa-wid
-                try:
-                    resp_alt = supabase.table('assistants').select('id, token, assistant_id').eq('x-quepasa-wid', x_quepasa_wid).execute()
-                    if resp_alt.data and len(resp_alt.data) > 0:
-                        logger.info(f"Assistente encontrado usando coluna 'x-quepasa-wid': {resp_alt.data[0]['id']}")
-                        response = resp_alt
-                    else:
-                        logger.error(f"Assistente não encontrado com 'x-quepasa-wid' também")
-                except Exception as e:
-                    logger.error(f"Erro ao buscar com x-quepasa-wid: {str(e)}")
-            
-            if not response.data or len(response.data) == 0:
-                return {"success": False, "message": "Assistente não configurado para este número"}
+        # Busca o assistente pelo x-quepasa-wid (em cache). Para mensagens do cliente que serão
+        # processadas, o status do contato é lido ao mesmo tempo: as duas consultas são independentes
+        if not from_me and message_type in MESSAGE_HANDLERS:
+            agent_data, current_status = await asyncio.gather(
+                get_assistant_by_wid(x_quepasa_wid),
+                get_contact_status(phone, x_quepasa_wid)
+            )
+        else:
+            agent_data = await get_assistant_by_wid(x_quepasa_wid)
+
+        if not agent_data:
+            logger.error("Nenhum assistente encontrado para x-quepasa-wid: %s", x_quepasa_wid)
+            # Diagnóstico (lista os assistentes cadastrados) apenas em nível DEBUG
+            if logger.isEnabledFor(logging.DEBUG):
+                all_assistants = await supabase_execute(supabase.table('assistants').select('id, token, assistant_id'))
+                logger.debug("Assistentes disponíveis: %s", len(all_assistants.data) if all_assistants.data else 0)
+                if all_assistants.data:
+                    logger.debug("Colunas disponíveis: %s", list(all_assistants.data[0].keys()))
+            return {"success": False, "message": "Assistente não configurado para este número"}
 
-        agent_data = response.data[0]
         agent_id = agent_data['id']
         token = agent_data['assistant_id']  # Usa o assistant_id como token
         openai_assistant_id = agent_data.get('assistant_id')  # ID do assistente na OpenAI
 
         if not openai_assistant_id:
-            logger.error(f"ID do assistente na OpenAI não encontrado para o agente {agent_id}")
+            logger.error("ID do assistente na OpenAI não encontrado para o agente %s", agent_id)
             return {"success": False, "message": "Assistente não configurado corretamente (falta ID OpenAI)"}
         
-        logger.info(f"ID do assistente na OpenAI: {openai_assistant_id}")
+        logger.info("ID do assistente na OpenAI: %s", openai_assistant_id)
         
         log_with_instance("Nova requisição recebida no webhook", agent_id)
-        log_with_instance(f"Processando mensagem de {phone}", agent_id)
-        log_with_instance(f"Tipo de mensagem: {message_type}", agent_id)
-        log_with_instance(f"De mim: {from_me}", agent_id)
-
-        # Primeiro, verifica o status atual do contato
-        contact_response = supabase.table('contacts').select('*').eq('whatsapp', phone).eq('x-quepasa-wid', x_quepasa_wid).execute()
-        contact = contact_response.data[0] if contact_response.data else None
-        current_status = contact['status'] if contact else None
-        
-        log_with_instance(f"Status atual do contato {phone}: {current_status}", agent_id)
+        log_with_instance("Processando mensagem de %s", agent_id, phone)
+        log_with_instance("Tipo de mensagem: %s", agent_id, message_type)
+        log_with_instance("De mim: %s", agent_id, from_me)
 
         # Se a mensagem é do sistema/usuário dono do bot (fromMe = true)
         if from_me:
-            log_with_instance(f"Mensagem enviada pelo sistema/dono para {phone}", agent_id)
+            log_with_instance("Mensagem enviada pelo sistema/dono para %s", agent_id, phone)
             try:
-                # Se o status atual é 'pausado', mantém pausado
-                if current_status == 'pausado':
-                    log_with_instance(f"Contato {phone} mantido como pausado", agent_id)
+                # Coloca o contato em cooldown, a não ser que esteja pausado (uma única ida ao banco)
+                status = await set_contact_cooldown(phone, x_quepasa_wid)
+                if status == 'pausado':
+                    log_with_instance("Contato %s mantido como pausado", agent_id, phone)
                     return {"success": True, "message": "Contato mantido como pausado"}
                 
-                # Caso contrário, atualiza para cooldown
-                cooldown_end = (datetime.utcnow() + timedelta(hours=24)).isoformat()
-                supabase.table('contacts').update({
-                    'last_contact': datetime.utcnow().isoformat(),
-                    'status': 'cooldown',
-                    'cooldown_until': cooldown_end,
-                    'from_me': True
-                }).eq('whatsapp', phone).eq('x-quepasa-wid', x_quepasa_wid).execute()
-                
-                log_with_instance(f"Contato {phone} colocado em cooldown por 24 horas", agent_id)
+                log_with_instance("Contato %s colocado em cooldown por 24 horas", agent_id, phone)
                 return {"success": True, "message": "Contato em cooldown após mensagem do sistema/dono"}
             except Exception as e:
-                log_with_instance(f"Erro ao atualizar status do contato: {str(e)}", agent_id, "ERROR")
+                log_with_instance("Erro ao atualizar status do contato: %s", agent_id, e, level="ERROR")
                 return {"success": False, "message": "Erro ao atualizar status do contato"}
         
         # Se a mensagem é do cliente (fromMe = false)
-        else:
-            log_with_instance(f"Mensagem recebida do cliente {phone}", agent_id)
-            # Continua o processamento normal para mensagens do cliente
+        log_with_instance("Mensagem recebida do cliente %s", agent_id, phone)
 
-        # Verifica novamente o status após qualquer atualização
-        contact_response = supabase.table('contacts').select('*').eq('whatsapp', phone).eq('x-quepasa-wid', x_quepasa_wid).execute()
-        contact = contact_response.data[0] if contact_response.data else None
-        current_status = contact['status'] if contact else None
-        
-        log_with_instance(f"Status verificado novamente para {phone}: {current_status}", agent_id)
+        # Tipos não suportados são descartados sem ler o status do contato nem o limite de contatos
+        handler = MESSAGE_HANDLERS.get(message_type)
+        if handler is None:
+            logger.warning("Tipo de mensagem não suportado: %s", message_type)
+            return {"success": False, "message": "Tipo de mensagem não suportado"}
+
+        # Status atual do contato, lido junto com o assistente (única leitura no webhook:
+        # process_delayed_message confere o status de novo antes de chamar o assistente)
+        log_with_instance("Status atual do contato %s: %s", agent_id, phone, current_status)
 
         # Se o contato está em cooldown ou pausado, não processa a mensagem
         if current_status in ['cooldown', 'pausado']:
-            log_with_instance(f"Mensagem descartada para {phone}. Status: {current_status}", agent_id)
+            log_with_instance("Mensagem descartada para %s. Status: %s", agent_id, phone, current_status)
             return {"success": False, "message": f"Contato {current_status}"}
 
         # Verifica limite de contatos
@@ -1463,103 +1573,52 @@ async def webhook(request: Request, x_quepasa_wid: str = Header(None, alias="x-q
                 token=token
             )
             
-            logger.warning(f"Limite de contatos excedido para agente {agent_id}")
+            logger.warning("Limite de contatos excedido para agente %s", agent_id)
             return {"status": "error", "message": "Contact limit exceeded"}
 
-        # Verifica o status uma última vez antes de processar a mensagem
-        contact_response = supabase.table('contacts').select('*').eq('whatsapp', phone).eq('x-quepasa-wid', x_quepasa_wid).execute()
-        contact = contact_response.data[0] if contact_response.data else None
-        current_status = contact['status'] if contact else None
-        
-        if current_status in ['cooldown', 'pausado']:
-            logger.info(f"Mensagem descartada para {phone}. Status final: {current_status}")
-            return {"success": False, "message": f"Contato {current_status}"}
-
-        # Processa diferentes tipos de mensagem
-        user_message = ""
-        
-        if message_type == "text":
-            # Mensagem de texto simples
-            user_message = message.text
-        elif message_type == "image":
-            try:
-                # Processa a imagem usando a nova função
-                image_description = await process_quepasa_image(message_id, token)
-                
-                # Envia a descrição como contexto para o assistente
-                user_message = f"O usuário enviou uma imagem. Descrição da imagem: {image_description}"
-                logger.info("Enviando descrição para o assistente como contexto")
-            except Exception as e:
-                logger.error(f"Erro ao processar imagem: {str(e)}")
-                user_message = "O usuário enviou uma imagem que não foi possível processar."
-        elif message_type == "audio":
-            try:
-                # Processa o áudio usando a nova função
-                logger.info(f"Iniciando processamento de áudio para message_id: {message_id}")
-                transcription = await process_quepasa_audio(message_id, token)
-                
-                logger.info(f"Áudio processado com sucesso. Transcrição: {transcription}")
-                
-                # Envia a transcrição como contexto para o assistente
-                user_message = f"O usuário enviou um áudio. Transcrição do áudio: {transcription}"
-            except Exception as e:
-                logger.error(f"Erro ao processar áudio: {str(e)}")
-                logger.error(traceback.format_exc())
-                user_message = "O usuário enviou um áudio que não foi possível transcrever."
-        else:
-            logger.warning(f"Tipo de mensagem não suportado: {message_type}")
-            return {"success": False, "message": "Tipo de mensagem não suportado"}
+        # Processa o tipo de mensagem (baixa a mídia e chama a OpenAI para imagem/áudio)
+        user_message = await handler(msg, token)
 
         if not user_message:
             return {"success": False, "message": "Mensagem vazia"}
 
-        # Verifica o status uma última vez antes de adicionar à fila
-        contact_response = supabase.table('contacts').select('*').eq('whatsapp', phone).eq('x-quepasa-wid', x_quepasa_wid).execute()
-        contact = contact_response.data[0] if contact_response.data else None
-        current_status = contact['status'] if contact else None
-        
-        if current_status in ['cooldown', 'pausado']:
-            logger.info(f"Mensagem descartada para {phone}. Status final antes da fila: {current_status}")
-            return {"success": False, "message": f"Contato {current_status}"}
-
-        # Adiciona a mensagem à lista de mensagens pendentes
+        # Adiciona a mensagem à fila do contato
         key = f"{phone}:{agent_id}"
-        if key not in pending_messages:
-            pending_messages[key] = []
+        slot = message_slots.get(key)
+        if slot is None:
+            slot = message_slots[key] = MessageSlot()
         
-        pending_messages[key].append(user_message)
-        log_with_instance(f"Mensagem adicionada à fila para {phone}. Total: {len(pending_messages[key])}", agent_id)
+        slot.queue.put_nowait(user_message)
+        log_with_instance("Mensagem adicionada à fila para %s. Total: %s", agent_id, phone, slot.queue.qsize())
         
-        # Se já existe uma tarefa pendente para este contato, não cria outra
-        if key in pending_tasks and not pending_tasks[key].done():
-            log_with_instance(f"Já existe uma tarefa pendente para {key}", agent_id)
+        # Se já existe uma tarefa consumindo a fila deste contato, ela pega a mensagem
+        if slot.task is not None and not slot.task.done():
+            log_with_instance("Já existe uma tarefa pendente para %s", agent_id, key)
             return {"success": True, "message": "Mensagem adicionada à fila existente"}
             
         # Cria uma nova tarefa para processar após 5 segundos
-        task = asyncio.create_task(
+        slot.task = asyncio.create_task(
             process_delayed_message(
                 phone=phone, 
                 agent_id=agent_id, 
                 token=token, 
                 quepasa_wid=x_quepasa_wid,
                 openai_assistant_id=openai_assistant_id,
-                chat_title=message.chat.title
+                chat_title=msg.chat_title
             )
         )
-        pending_tasks[key] = task
-        log_with_instance(f"Nova tarefa de processamento criada para {key}", agent_id)
+        slot.task.add_done_callback(partial(release_message_slot, key))
+        log_with_instance("Nova tarefa de processamento criada para %s", agent_id, key)
 
         return {"success": True, "message": "Mensagem adicionada à fila"}
 
     except Exception as e:
         # Tenta identificar o agent_id para log, caso não tenha sido definido ainda
         agent_id = "unknown"
-        if hasattr(message_data, 'chat') and hasattr(message_data.chat, 'id'):
-            phone = message_data.chat.id.split('@')[0]
-            logger.error(f"Erro no processamento para {phone}: {str(e)}")
+        if msg is not None:
+            logger.error("Erro no processamento para %s: %s", msg.phone, e)
         
-        log_with_instance(f"Erro no processamento: {str(e)}", agent_id, "ERROR")
-        logger.error(traceback.format_exc())
+        log_with_instance("Erro no processamento: %s", agent_id, e, level="ERROR", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
@@ -1570,30 +1629,41 @@ async def health_check():
         "openai": "configured"
     }
 
+def encode_base64(data: bytes) -> str:
+    """Codifica bytes em base64 (texto ASCII)."""
+    return base64.b64encode(data).decode('ascii')
+
 async def download_image(url: str, headers: Dict) -> str:
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                # Converte a imagem para base64
-                return base64.b64encode(response.content).decode('utf-8')
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Erro ao baixar imagem")
+        response = await app.state.http.get(url, headers=headers)
+        if response.status_code == 200:
+            # Converte a imagem para base64 em uma thread, sem bloquear o event loop
+            return await asyncio.to_thread(encode_base64, response.content)
+        else:
+            raise HTTPException(status_code=response.status_code, detail="Erro ao baixar imagem")
     except Exception as e:
-        logger.error(f"Erro ao baixar imagem: {str(e)}")
+        logger.error("Erro ao baixar imagem: %s", e, exc_info=True)
         raise
 
 async def download_audio(url: str, headers: Dict) -> str:
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                # Converte o áudio para base64
-                return base64.b64encode(response.content).decode('utf-8')
-            else:
+        async with app.state.http.stream("GET", url, headers=headers) as response:
+            if response.status_code != 200:
                 raise HTTPException(status_code=response.status_code, detail="Erro ao baixar áudio")
+
+            # Converte o áudio para base64 em blocos de 64 KB, sem manter o arquivo bruto inteiro em memória
+            encoded_parts = []
+            pending = b""
+            async for chunk in response.aiter_bytes(65536):
+                pending += chunk
+                # Codifica apenas múltiplos de 3 bytes para que as partes possam ser concatenadas
+                cut = len(pending) - len(pending) % 3
+                encoded_parts.append(base64.b64encode(pending[:cut]).decode('utf-8'))
+                pending = pending[cut:]
+            encoded_parts.append(base64.b64encode(pending).decode('utf-8'))
+            return "".join(encoded_parts)
     except Exception as e:
-        logger.error(f"Erro ao baixar áudio: {str(e)}")
+        logger.error("Erro ao baixar áudio: %s", e, exc_info=True)
         raise
 
 # Função para baixar mídia do Quepasa
@@ -1605,18 +1675,12 @@ async def download_quepasa_media(message_id: str, token: str) -> Optional[bytes]
         }
         
         # Ensure QUEPASA_API_URL has a protocol
-        api_url = QUEPASA_API_URL
-        if not api_url.startswith(("http://", "https://")):
-            # Default to https if no protocol is found
-            api_url = f"https://{api_url}"
-            logger.warning(f"QUEPASA_API_URL in download_quepasa_media was missing protocol. Prepended 'https://'. New URL: {api_url}")
-
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{api_url}/download/{message_id}?cache=false", # Use the potentially modified api_url
-                headers=headers,
-                timeout=30
-            )
+        api_url = quepasa_api_url()
+
+        response = await app.state.http.get(
+            f"{api_url}/download/{message_id}?cache=false", # Use the potentially modified api_url
+            headers=headers
+        )
             
         if response.status_code != 200:
             logger.error(f"Erro ao baixar mídia. Status: {response.status_code}")
@@ -1625,7 +1689,7 @@ async def download_quepasa_media(message_id: str, token: str) -> Optional[bytes]
         logger.info(f"Mídia baixada com sucesso. Tamanho: {len(response.content)} bytes")
         return response.content
     except Exception as e:
-        logger.error(f"Erro ao baixar mídia: {str(e)}")
+        logger.error("Erro ao baixar mídia: %s", e, exc_info=True)
         return None
 
 # Função para processar áudio do Quepasa
@@ -1637,30 +1701,18 @@ async def process_quepasa_audio(message_id: str, token: str) -> str:
         if not audio_data:
             return "[Não foi possível baixar o áudio]"
         
-        # Salva em arquivo temporário
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_audio:
-            temp_audio.write(audio_data)
-            temp_audio_path = temp_audio.name
-        
-        logger.info(f"Arquivo de áudio salvo temporariamente em: {temp_audio_path}")
-        
-        # Transcreve o áudio usando OpenAI
-        with open(temp_audio_path, 'rb') as audio_file:
-            transcript = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-        
-        # Limpa o arquivo temporário
-        os.unlink(temp_audio_path)
+        # Transcreve o áudio usando OpenAI, enviando os bytes já em memória (sem arquivo temporário)
+        transcript = await openai_client.audio.transcriptions.create(
+            model="whisper-1",
+            file=("audio.ogg", audio_data, "audio/ogg")
+        )
         
         # Log do resultado da transcrição
         logger.info(f"Transcrição do áudio concluída: {transcript.text}")
         
         return transcript.text
     except Exception as e:
-        logger.error(f"Erro ao processar áudio: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.error("Erro ao processar áudio: %s", e, exc_info=True)
         return "[Não foi possível transcrever o áudio]"
 
 # Função para processar imagem do Quepasa
@@ -1672,11 +1724,11 @@ async def process_quepasa_image(message_id: str, token: str) -> str:
         if not image_data:
             return "[Não foi possível baixar a imagem]"
         
-        # Converte para base64
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
+        # Converte para base64 em uma thread, sem bloquear o event loop em imagens grandes
+        image_base64 = await asyncio.to_thread(encode_base64, image_data)
         
         # Analisa a imagem usando gpt-4o
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o",
             messages=[
                 {
@@ -1689,7 +1741,8 @@ async def process_quepasa_image(message_id: str, token: str) -> str:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
+                                "url": f"data:image/jpeg;base64,{image_base64}",
+                                "detail": "low"  # 85 tokens por imagem; suficiente para fotos do WhatsApp
                             }
                         }
                     ]
@@ -1700,9 +1753,48 @@ async def process_quepasa_image(message_id: str, token: str) -> str:
         
         return response.choices[0].message.content
     except Exception as e:
-        logger.error(f"Erro ao processar imagem: {str(e)}")
+        logger.error("Erro ao processar imagem: %s", e, exc_info=True)
         return "[Não foi possível analisar a imagem]"
 
+async def handle_text_message(msg: WebhookMsg, token: str) -> str:
+    """Mensagem de texto simples."""
+    return msg.text
+
+async def handle_image_message(msg: WebhookMsg, token: str) -> str:
+    """Imagem: envia a descrição como contexto para o assistente."""
+    try:
+        # Processa a imagem usando a nova função
+        image_description = await process_quepasa_image(msg.message_id, token)
+        
+        # Envia a descrição como contexto para o assistente
+        logger.info("Enviando descrição para o assistente como contexto")
+        return f"O usuário enviou uma imagem. Descrição da imagem: {image_description}"
+    except Exception as e:
+        logger.error("Erro ao processar imagem: %s", e)
+        return "O usuário enviou uma imagem que não foi possível processar."
+
+async def handle_audio_message(msg: WebhookMsg, token: str) -> str:
+    """Áudio: envia a transcrição como contexto para o assistente."""
+    try:
+        # Processa o áudio usando a nova função
+        logger.info("Iniciando processamento de áudio para message_id: %s", msg.message_id)
+        transcription = await process_quepasa_audio(msg.message_id, token)
+        
+        logger.info("Áudio processado com sucesso. Transcrição: %s", transcription)
+        
+        # Envia a transcrição como contexto para o assistente
+        return f"O usuário enviou um áudio. Transcrição do áudio: {transcription}"
+    except Exception as e:
+        logger.exception("Erro ao processar áudio: %s", e)
+        return "O usuário enviou um áudio que não foi possível transcrever."
+
+# Tipos de mensagem do Quepasa tratados pelo webhook; os demais são descartados
+MESSAGE_HANDLERS = {
+    'text': handle_text_message,
+    'image': handle_image_message,
+    'audio': handle_audio_message
+}
+
 # Adiciona endpoint de teste
 @app.get("/test")
 async def test_endpoint():
@@ -1715,34 +1807,132 @@ logger.info(f"URL da API Quepasa: {QUEPASA_API_URL}")
 logger.info(f"URL do servidor: http://0.0.0.0:3004")
 logger.info("=== SERVIDOR INICIALIZADO ===")
 
+def _tcp_probe(url: str):
+    """Abre e fecha uma conexão TCP com o host da URL."""
+    parsed = urlparse(url)
+    if not parsed.hostname:
+        raise ValueError(f"URL inválida: '{url}'")
+    port = parsed.port or (80 if parsed.scheme == "http" else 443)
+    socket.create_connection((parsed.hostname, port), timeout=3).close()
+
+async def _preflight() -> bool:
+    """Verifica Supabase e OpenAI em paralelo antes de subir o servidor.
+    Retorna False se alguma das verificações falhar."""
+    supabase_result, openai_result = await asyncio.gather(
+        asyncio.to_thread(_tcp_probe, SUPABASE_URL),
+        asyncio.to_thread(_tcp_probe, str(openai_client.base_url)),
+        return_exceptions=True
+    )
+
+    if isinstance(supabase_result, Exception):
+        logger.error("⚠️ ERRO DE INICIALIZAÇÃO: Falha ao conectar ao Supabase: %s", supabase_result, exc_info=supabase_result)
+    else:
+        logger.info("Conexão com Supabase estabelecida com sucesso")
+
+    if isinstance(openai_result, Exception):
+        logger.error("⚠️ ERRO DE INICIALIZAÇÃO: Falha ao conectar à OpenAI: %s", openai_result, exc_info=openai_result)
+    else:
+        logger.info("Conexão com OpenAI estabelecida com sucesso")
+
+    return not isinstance(supabase_result, Exception) and not isinstance(openai_result, Exception)
+
+def _serve_reuseport(server_options: dict, workers: int):
+    """Sobe um processo por worker, cada um com seu socket na mesma porta,
+    e deixa o kernel distribuir as conexões entre eles."""
+    # Os filhos rodam o worker.py, que importa o main só uma vez (pelo uvicorn)
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py"),
+        orjson.dumps(server_options).decode(),
+        "3004"
+    ]
+    processes = [subprocess.Popen(command) for _ in range(workers)]
+    logger.info(f"{workers} processos do servidor iniciados com SO_REUSEPORT na porta 3004")
+
+    # Repassa o encerramento para os processos filhos
+    stopping = False
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    # Espera o primeiro processo terminar: no encerramento são todos; fora dele,
+    # um worker caiu e o servidor inteiro sai para o orquestrador reiniciar o contêiner
+    while True:
+        exited = next((process for process in processes if process.poll() is not None), None)
+        if exited is not None:
+            break
+        time.sleep(1)
+
+    crashed = not stopping
+    if crashed:
+        logger.error(
+            "Processo do servidor %s encerrou com código %s; encerrando os demais",
+            exited.pid, exited.returncode
+        )
+        stop_workers(None, None)
+    for process in processes:
+        process.wait()
+
+    if crashed:
+        shutdown_logging()
+        raise SystemExit(exited.returncode if exited.returncode > 0 else 1)
+
 if __name__ == "__main__":
-    import uvicorn
+    # Instala o uvloop antes de qualquer chamada ao asyncio, para que a verificação
+    # inicial e o servidor usem o mesmo loop acelerado
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     logger.info("Iniciando servidor...")
     try:
         # Verifica se todas as dependências necessárias estão presentes
         logger.info("Verificando dependências necessárias...")
-        
-        # Tenta criar um cliente do Supabase
-        try:
-            supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
-            logger.info("Conexão com Supabase estabelecida com sucesso")
-        except Exception as e:
-            logger.error(f"⚠️ ERRO DE INICIALIZAÇÃO: Falha ao conectar ao Supabase: {str(e)}")
-            
-        # Tenta criar um cliente OpenAI
-        try:
-            openai_test = OpenAI(api_key=OPENAI_API_KEY)
-            logger.info("Cliente OpenAI inicializado com sucesso")
-        except Exception as e:
-            logger.error(f"⚠️ ERRO DE INICIALIZAÇÃO: Falha ao inicializar OpenAI: {str(e)}")
-        
-        # Inicia o servidor com desativação de recarregamento automático
-        logger.info("Iniciando servidor Uvicorn...")
-        uvicorn.run("main:app", host="0.0.0.0", port=3004, reload=False)
-    except Exception as e:
-        logger.error(f"⚠️ ERRO CRÍTICO: O servidor falhou ao iniciar: {str(e)}")
-        logger.error(f"Stack trace: {traceback.format_exc()}")
-        # Aguarda um pouco antes de sair para garantir que os logs sejam gravados
-        import time
-        time.sleep(5)
+        if not asyncio.run(_preflight()):
+            # Não sobe o servidor quebrado: o orquestrador reinicia o contêiner
+            logger.error("⚠️ ERRO CRÍTICO: Verificação de dependências falhou. Encerrando.")
+            shutdown_logging()
+            raise SystemExit(1)
+
+        # Escuta em socket UNIX se configurado, senão em TCP na porta 3004
+        if UVICORN_UDS:
+            bind = {"uds": UVICORN_UDS}
+            logger.info(f"Iniciando servidor Uvicorn no socket {UVICORN_UDS}...")
+        else:
+            bind = {"host": "0.0.0.0", "port": 3004}
+            logger.info("Iniciando servidor Uvicorn...")
+
+        # Inicia o servidor com desativação de recarregamento automático.
+        # O log de acesso fica desligado (o middleware log_requests já registra cada
+        # requisição) e os logs do uvicorn seguem pela configuração de logging acima
+        server_options = dict(
+            reload=False,
+            access_log=False,
+            log_config=None,
+            server_header=False,
+            date_header=False,
+            # Valores explícitos evitam a detecção automática na inicialização
+            lifespan="on",
+            interface="asgi3",
+            use_colors=False
+        )
+
+        if WEB_CONCURRENCY > 1 and not UVICORN_UDS and hasattr(socket, "SO_REUSEPORT"):
+            _serve_reuseport(server_options, WEB_CONCURRENCY)
+        else:
+            # Com um único processo, serve o próprio objeto app: passar "main:app" faria o uvicorn
+            # importar o módulo de novo (este arquivo roda como __main__), criando outra vez os
+            # clientes OpenAI/Supabase. Com vários workers o uvicorn exige a string de importação
+            target = app if WEB_CONCURRENCY == 1 else "main:app"
+            uvicorn.run(target, **bind, workers=WEB_CONCURRENCY, **server_options)
+    except Exception:
+        logger.exception("⚠️ ERRO CRÍTICO: O servidor falhou ao iniciar")
+        # Grava os logs pendentes antes de sair
+        shutdown_logging()
         raise 
\ No newline at end of file
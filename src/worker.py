@@ -0,0 +1,21 @@
+"""Processo filho do servidor com SO_REUSEPORT, iniciado pelo main.py.
+
+Fica fora do main.py para que cada processo importe a aplicação uma única vez
+(pelo uvicorn, como "main:app"), sem recriar clientes e threads de log.
+"""
+import socket
+import sys
+
+import orjson
+import uvicorn
+
+def run(server_options: dict, port: int):
+    """Abre um socket próprio com SO_REUSEPORT na porta e serve a aplicação."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", port))
+    uvicorn.Server(uvicorn.Config("main:app", **server_options)).run(sockets=[sock])
+
+if __name__ == "__main__":
+    run(orjson.loads(sys.argv[1]), int(sys.argv[2]))
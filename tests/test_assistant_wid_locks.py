@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+# O módulo valida as credenciais ao ser importado; valores fictícios bastam para os testes
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("QUEPASA_API_URL", "https://quepasa.example")
+os.environ.setdefault("SUPABASE_URL", "https://example.supabase.co")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.e30.x")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import main  # noqa: E402
+
+
+class AssistantWidLocksTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        main.assistant_wid_cache.clear()
+
+    async def test_unknown_wids_do_not_grow_lock_map(self):
+        async def not_found(query):
+            return SimpleNamespace(data=[])
+
+        with patch.object(main, "supabase_execute", not_found):
+            for i in range(100):
+                self.assertIsNone(await main.get_assistant_by_wid(f"desconhecido-{i}"))
+
+        self.assertEqual(len(main.assistant_wid_locks), 0)
+
+    async def test_concurrent_lookups_share_one_query(self):
+        calls = 0
+
+        async def found(query):
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return SimpleNamespace(data=[{"id": "a1", "token": "t", "assistant_id": "asst"}])
+
+        with patch.object(main, "supabase_execute", found):
+            results = await asyncio.gather(*(main.get_assistant_by_wid("wid-1") for _ in range(5)))
+
+        self.assertEqual(calls, 1)
+        self.assertTrue(all(result["id"] == "a1" for result in results))
+        self.assertEqual(len(main.assistant_wid_locks), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()